@@ -0,0 +1,85 @@
+"""Policies for the delay before a task is retried after a ConflictError.
+
+A policy is configured by its dotted name in `CONFLICT_BACKOFF` in the celery
+config. It is instantiated once per process and has to provide:
+
+* `countdown(task, retries)`: seconds to wait before retry number
+  `retries + 1` of the current call of `task`
+* `conflict(task)`: the current call of `task` ran into a conflict
+* `success(task)`: the current call of `task` was committed
+"""
+import collections
+import random
+import threading
+
+
+class ExponentialBackoff:
+    """Wait a random time of up to `2 ** retries` seconds."""
+
+    def countdown(self, task, retries):
+        return random.uniform(0, 2 ** retries)
+
+    def conflict(self, task):
+        pass
+
+    def success(self, task):
+        pass
+
+
+class AdaptiveBackoff:
+    """Stretch or shrink the exponential backoff by the recent conflict rate.
+
+    The conflict rate is tracked per task name and, for tasks with an
+    `affinity`, per affinity key as moving average with the given `weight`
+    of each call. The upper bound of the (random) delay is
+    `2 ** retries` seconds times a factor between `min_factor` (no recent
+    conflicts) and `max_factor` (only conflicts), but at most `max_delay`.
+    Rates are kept for the `maxsize` most recently used keys.
+    """
+
+    def __init__(self, weight=0.1, min_factor=0.5, max_factor=4,
+                 max_delay=300, maxsize=1000):
+        self.weight = weight
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.max_delay = max_delay
+        self.maxsize = maxsize
+        self._rates = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _keys(self, task):
+        keys = [task.name]
+        if task.affinity is not None:
+            request = task.request
+            key = task._affinity_key(request.args, request.kwargs)
+            if key is not None:
+                keys.append((task.name, key))
+        return keys
+
+    def _update(self, task, value):
+        keys = self._keys(task)
+        with self._lock:
+            for key in keys:
+                rate = self._rates.pop(key, 0.0)
+                self._rates[key] = rate + self.weight * (value - rate)
+            while len(self._rates) > self.maxsize:
+                self._rates.popitem(last=False)
+
+    def rate(self, task):
+        """Return the recent conflict rate of the current call of `task`."""
+        keys = self._keys(task)
+        with self._lock:
+            return max(self._rates.get(key, 0.0) for key in keys)
+
+    def countdown(self, task, retries):
+        factor = self.min_factor + (
+            self.max_factor - self.min_factor) * self.rate(task)
+        # Random delays (instead of e.g. the upper bound) keep conflicting
+        # calls from retrying at the same time again.
+        return random.uniform(0, min(self.max_delay, 2 ** retries * factor))
+
+    def conflict(self, task):
+        self._update(task, 1.0)
+
+    def success(self, task):
+        self._update(task, 0.0)
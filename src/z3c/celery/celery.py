@@ -1,17 +1,29 @@
 from .loader import ZopeLoader
-from .session import celery_session
+from .session import CeleryDataManager, celery_session
+from .timing import phase
 from celery._state import _task_stack
 from celery.utils.serialization import raise_with_context
 import celery
 import celery.exceptions
 import celery.utils
+import celery.utils.imports
+import collections
 import contextlib
+import functools
+import inspect
+import itertools
 import json
 import logging
-import random
 import socket
 import time
+import threading
 import transaction
+import z3c.celery.conflicts
+import z3c.celery.logging
+import z3c.celery.memoize
+import z3c.celery.prefetch
+import z3c.celery.serialization
+import zlib
 import zope.app.publication.zopepublication
 import zope.authentication.interfaces
 import zope.component
@@ -21,6 +33,25 @@ import zope.security.management
 
 
 log = logging.getLogger(__name__)
+# Zope state kept across tasks, per thread of a worker process.
+_worker_state = threading.local()
+# Guards the creation of the per-process objects kept in the celery config.
+_conf_lock = threading.Lock()
+
+
+def _conf_singleton(conf, key, factory):
+    """Return `conf[key]`, setting it to `factory()` first if it is unset.
+
+    Threads of a worker process share the celery config, so only one of them
+    may create the object.
+    """
+    value = conf.get(key)
+    if value is None:
+        with _conf_lock:
+            value = conf.get(key)
+            if value is None:
+                value = conf[key] = factory()
+    return value
 
 
 class HandleAfterAbort(RuntimeError):
@@ -73,6 +104,10 @@ class Retry(celery.exceptions.Retry, HandleAfterAbort):
             raise celery.exceptions.Reject(exc, requeue=False)
 
 
+class ReadOnlyError(RuntimeError):
+    """A task declared as `read_only` modified data."""
+
+
 def get_principal(principal_id):
     """Return the principal to the principal_id."""
     auth = zope.component.getUtility(
@@ -80,10 +115,62 @@ def get_principal(principal_id):
     return auth.getPrincipal(principal_id)
 
 
+class PrincipalCache:
+    """Cache principals returned by `get_principal` for `ttl` seconds.
+
+    At most `maxsize` principals are kept, the least recently used ones are
+    dropped first.
+    """
+
+    def __init__(self, ttl, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._principals = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, principal_id):
+        now = time.monotonic()
+        with self._lock:
+            expires, principal = self._principals.get(
+                principal_id, (0, None))
+            if expires > now:
+                self._principals.move_to_end(principal_id)
+                return principal
+        principal = get_principal(principal_id)
+        with self._lock:
+            self._principals[principal_id] = (now + self.ttl, principal)
+            self._principals.move_to_end(principal_id)
+            while len(self._principals) > self.maxsize:
+                self._principals.popitem(last=False)
+        return principal
+
+    def clear(self):
+        with self._lock:
+            self._principals.clear()
+
+
+def affinity_queues(app):
+    """Return the names of the partition queues for tasks with an affinity.
+
+    Each of these queues has to be consumed by a worker with a concurrency
+    of 1, so the tasks in it run one after another. The names start with
+    `AFFINITY_QUEUE_PREFIX` (optional, default: `z3c.celery.affinity`).
+    """
+    prefix = app.conf.get('AFFINITY_QUEUE_PREFIX') or 'z3c.celery.affinity'
+    return ['%s.%s' % (prefix, i)
+            for i in range(app.conf.get('AFFINITY_QUEUES') or 0)]
+
+
+@functools.lru_cache(maxsize=None)
+def _server_url():
+    # socket.getfqdn() does a DNS lookup, so we do it only once per process.
+    return 'http://%s' % socket.getfqdn()
+
+
 def login_principal(principal, task_name=None):
     """Start an interaction with `principal`."""
     request = zope.publisher.browser.TestRequest(
-        environ={'SERVER_URL': 'http://%s' % socket.getfqdn()})
+        environ={'SERVER_URL': _server_url()})
     if task_name:
         # I'd rather set PATH_INFO, but that doesn't influence getURL().
         request._traversed_names = ['celery', task_name]
@@ -115,6 +202,7 @@ class TransactionAwareTask(celery.Task):
         """
         run_asynchronously = kw.pop('_run_asynchronously_', False)
         principal_id = kw.pop('_principal_id_', None)
+        chunk = kw.pop('_chunk_', None)
         # BBB This was removed in 1.2.0 but there still might be (scheduled)
         # tasks that transmit this argument, so we need to remove it.
         kw.pop('_task_id_', None)
@@ -131,7 +219,9 @@ class TransactionAwareTask(celery.Task):
             # was set by app.trace; but as it's not called, it's not an issue.)
             _task_stack.push(self)
         try:
-            if run_asynchronously:
+            if chunk is not None:
+                result = self.run_chunk(chunk, run_asynchronously)
+            elif run_asynchronously:
                 result = self.run_in_worker(principal_id, args, kw)
             else:
                 result = self.run_in_same_process(args, kw)
@@ -141,39 +231,135 @@ class TransactionAwareTask(celery.Task):
         return result
 
     def run_in_same_process(self, args, kw):
+        with z3c.celery.logging.context(self):
+            try:
+                return self.run(*args, **kw)
+            except Abort as handle:
+                transaction.abort()
+                handle()
+                return handle.message
+            except HandleAfterAbort as handle:
+                handle()
+                raise
+
+    def run_chunk(self, chunk, run_asynchronously):
+        """Run the `[args, kw]` items of a chunk message one after another.
+
+        Each item runs in its own transaction. To retry only the item that
+        raised a ConflictError (and not the whole chunk), the request is
+        updated to look like the item was sent as a message of its own.
+        Failing items do not prevent the following items from running, the
+        first error is re-raised after the chunk is done.
+
+        If the task has `chunk_batch` set, consecutive items of the same
+        principal run in one transaction instead. If that fails (e.g. one of
+        them raises or the transaction conflicts), it is aborted and the items
+        are run one by one as described above, so only the failing items
+        report their errors.
+        """
+        results = []
+        error = None
+        if self.chunk_batch and run_asynchronously:
+            groups = [list(items) for principal_id, items in itertools.groupby(
+                chunk, key=lambda item: item[1].get('_principal_id_'))]
+        else:
+            groups = [chunk]
+        for items in groups:
+            group_results = None
+            if self.chunk_batch and run_asynchronously:
+                group_results = self._run_batch(items)
+            if group_results is None:
+                group_results, group_error = self._run_items(
+                    items, run_asynchronously)
+                if error is None:
+                    error = group_error
+            results.extend(group_results)
+        if error is not None:
+            raise error
+        return results
+
+    def _run_items(self, items, run_asynchronously):
+        """Run `[args, kw]` items each on its own, see `run_chunk`.
+
+        Returns the results and the first error (or None).
+        """
+        request = self.request
+        chunk_id, chunk_args, chunk_kwargs = (
+            request.id, request.args, request.kwargs)
+        results = []
+        error = None
         try:
-            return self.run(*args, **kw)
-        except Abort as handle:
-            transaction.abort()
-            handle()
-            return handle.message
-        except HandleAfterAbort as handle:
-            handle()
-            raise
+            for args, kw in items:
+                kw = dict(kw)
+                kw.setdefault('_run_asynchronously_', run_asynchronously)
+                # Each item gets an id of its own, so retried items do not
+                # share the task_id of the chunk.
+                request.id = celery.utils.gen_unique_id()
+                request.args, request.kwargs = args, kw
+                try:
+                    results.append(self(*args, **dict(kw)))
+                except celery.exceptions.Retry:
+                    # The item was submitted again as a task of its own.
+                    results.append(None)
+                except Exception as err:
+                    log.error('Error in chunk of %s', self.name, exc_info=True)
+                    results.append(None)
+                    if error is None:
+                        error = err
+        finally:
+            request.id, request.args, request.kwargs = (
+                chunk_id, chunk_args, chunk_kwargs)
+        return results, error
+
+    def _run_batch(self, items):
+        """Run `[args, kw]` items of the same principal in one transaction.
+
+        Returns their results or None if running or committing failed, so
+        the items can be run one by one.
+        """
+        principal_id = items[0][1].get('_principal_id_')
+        try:
+            with z3c.celery.logging.context(self), self.configure_zope():
+                with self.transaction(
+                        principal_id, self.read_only, retry=False):
+                    results = []
+                    for args, kw in items:
+                        kw = {key: value for key, value in kw.items()
+                              if key not in (
+                                  '_principal_id_', '_run_asynchronously_')}
+                        results.append(self._run(principal_id, args, kw))
+        except Exception:
+            log.warning('Batch of %s calls of %s failed, running them one by '
+                        'one.', len(items), self.name, exc_info=True)
+            return None
+        return results
+
+    def _run(self, principal_id, args, kw):
+        """Run the task in the current transaction.
+
+        Applies `prefetch` and returns the memoized result if there is one.
+        """
+        with self._prefetch(args, kw):
+            memo = self._memo(principal_id, args, kw)
+            if memo is not None and memo.hit:
+                return memo.result
+            with phase(self, 'run'):
+                result = self.run(*args, **kw)
+            if memo is not None and self.read_only:
+                memo.store(result)
+            elif memo is not None:
+                transaction.get().addAfterCommitHook(
+                    memo.store_after_commit, (result,))
+            return result
 
     def run_in_worker(self, principal_id, args, kw, retries=0):
-        with self.configure_zope():
+        with z3c.celery.logging.context(self), self.configure_zope():
             try:
-                with self.transaction(principal_id):
-                    return self.run(*args, **kw)
+                with self.transaction(principal_id, self.read_only):
+                    return self._run(principal_id, args, kw)
             except HandleAfterAbort as handle:
-                for handle_retries in range(self.max_retries):
-                    try:
-                        with self.transaction(principal_id):
-                            handle()
-                    except celery.exceptions.Retry:
-                        # We have to handle ConflictErrors manually, since we
-                        # don't want to retry the whole task (which was
-                        # erroneous anyway), but only the after-abort portion.
-                        countdown = random.uniform(0, 2 ** handle_retries)
-                        log.warning('Waiting %s seconds for retry.', countdown)
-                        time.sleep(countdown)
-                        continue
-                    else:
-                        break
-                else:
-                    log.warning('Giving up on %r after %s retries',
-                                handle, self.max_retries)
+                with phase(self, 'after_abort'):
+                    self._handle_after_abort(handle, principal_id)
 
                 if isinstance(handle, Abort):
                     return handle.message
@@ -181,53 +367,297 @@ class TransactionAwareTask(celery.Task):
                     raise handle
 
     @contextlib.contextmanager
-    def transaction(self, principal_id):
+    def _prefetch(self, args, kw):
+        """Prefetch the objects the task declares in `prefetch` in bulk."""
+        if self.prefetch is None:
+            yield
+            return
+        with phase(self, 'prefetch'):
+            items = self.prefetch
+            if callable(items):
+                items = items(*args, **kw)
+            site = zope.component.hooks.getSite()
+            prefetched = z3c.celery.prefetch.ghosts(
+                z3c.celery.prefetch.resolve(site, items))
+            if prefetched:
+                site._p_jar.prefetch(prefetched)
+        try:
+            yield
+        finally:
+            z3c.celery.prefetch.report(self, prefetched)
+
+    def _memo(self, principal_id, args, kw):
+        """Return the memo of the call if the task declares `memoize` and
+        the objects it depends on exist, otherwise None."""
+        if self.memoize is None:
+            return None
+        with phase(self, 'memoize'):
+            items = self.memoize
+            if callable(items):
+                items = items(*args, **kw)
+            objects = z3c.celery.prefetch.resolve(
+                zope.component.hooks.getSite(), items)
+            if not objects:
+                return None
+            ghosts = z3c.celery.prefetch.ghosts(objects)
+            if ghosts:
+                objects[0]._p_jar.prefetch(ghosts)
+            memo = z3c.celery.memoize.Memo(
+                self._memoize_cache(),
+                z3c.celery.memoize.key(
+                    self, principal_id, self._serialize_arguments(args, kw)),
+                z3c.celery.memoize.serials(objects))
+        if memo.hit:
+            log.debug('%s: using memoized result %s', self.name, memo.key)
+        return memo
+
+    def _memoize_cache(self):
+        """Return the cache for the results of tasks which declare `memoize`,
+        given by its dotted name in `MEMOIZE_CACHE` (optional, default:
+        `z3c.celery.memoize.LRUCache`)."""
+        conf = self.app.conf
+        return _conf_singleton(
+            conf, 'MEMOIZE_CACHE_BACKEND',
+            lambda: celery.utils.imports.symbol_by_name(
+                conf.get('MEMOIZE_CACHE') or
+                'z3c.celery.memoize.LRUCache')(self.app))
+
+    def _handle_after_abort(self, handle, principal_id):
+        for handle_retries in range(self.max_retries):
+            try:
+                with self.transaction(principal_id):
+                    handle()
+            except celery.exceptions.Retry:
+                # We have to handle ConflictErrors manually, since we don't
+                # want to retry the whole task (which was erroneous anyway),
+                # but only the after-abort portion.
+                countdown = self._backoff().countdown(self, handle_retries)
+                if self._defer_after_abort(handle, principal_id, countdown):
+                    break
+                log.warning('Waiting %s seconds for retry.', countdown)
+                time.sleep(countdown)
+                continue
+            else:
+                break
+        else:
+            log.warning('Giving up on %r after %s retries',
+                        handle, self.max_retries)
+
+    def _defer_after_abort(self, handle, principal_id, countdown):
+        """Retry the after-abort portion in a task of its own, so the worker
+        does not have to wait, if `DEFER_AFTER_ABORT_RETRY` is set.
+
+        This requires the callback to be importable by its dotted name and
+        its arguments to be JSON serializable. Returns whether the retry was
+        deferred.
+        """
+        if not self.app.conf.get('DEFER_AFTER_ABORT_RETRY'):
+            return False
+        callback = getattr(handle, 'callback', None)
+        if callback is None:
+            return False
+        try:
+            name = '{0.__module__}:{0.__qualname__}'.format(callback)
+            if celery.utils.imports.symbol_by_name(name) is not callback:
+                return False
+            self._serialize_arguments(handle.c_args, handle.c_kwargs)
+        except (AttributeError, ImportError, TypeError):
+            return False
+        with self.transaction(principal_id):
+            run_after_abort.apply_async(
+                (name, handle.c_args, handle.c_kwargs), countdown=countdown)
+        log.warning('Retrying %s in %s seconds in a separate task.',
+                    name, countdown)
+        return True
+
+    @contextlib.contextmanager
+    def transaction(self, principal_id, read_only=False, retry=True):
+        """Run the body in a transaction as `principal_id` and commit it.
+
+        ConflictErrors are retried by retrying the task, unless `retry` is
+        false.
+
+        With `read_only` the transaction is not committed but aborted and
+        ConflictErrors are not retried. If the body modified anything besides
+        queueing tasks, ReadOnlyError is raised.
+        """
         if principal_id:
             transaction.begin()
-            login_principal(get_principal(principal_id), self.name)
-            txn = transaction.get()
-            txn.setUser(str(principal_id))
-            txn.setExtendedInfo('task_name', self.name)
+            with phase(self, 'login'):
+                login_principal(self._get_principal(principal_id), self.name)
+            if not read_only:
+                txn = transaction.get()
+                txn.setUser(str(principal_id))
+                txn.setExtendedInfo('task_name', self.name)
         try:
             yield
-        except transaction.interfaces.TransientError:
-            log.warning('ConflictError, retrying', exc_info=True)
+        except transaction.interfaces.TransientError as err:
             transaction.abort()
-            self.retry(
-                countdown=random.uniform(0, 2 ** self.request.retries))
+            z3c.celery.conflicts.record(self, err, 'run')
+            self._backoff().conflict(self)
+            if read_only or not retry:
+                raise
+            log.warning('ConflictError, retrying', exc_info=True)
+            with phase(self, 'retry'):
+                self.retry(countdown=self._backoff().countdown(
+                    self, self.request.retries))
         except Exception:
             transaction.abort()
             raise
         else:
+            if read_only:
+                self._finish_read_only()
+                return
             try:
-                transaction.commit()
-            except transaction.interfaces.TransientError:
-                log.warning('ConflictError, retrying', exc_info=True)
+                with phase(self, 'commit'):
+                    transaction.commit()
+            except transaction.interfaces.TransientError as err:
                 transaction.abort()
-                self.retry(
-                    countdown=random.uniform(0, 2 ** self.request.retries))
+                z3c.celery.conflicts.record(self, err, 'commit')
+                self._backoff().conflict(self)
+                if not retry:
+                    raise
+                log.warning('ConflictError, retrying', exc_info=True)
+                with phase(self, 'retry'):
+                    self.retry(countdown=self._backoff().countdown(
+                        self, self.request.retries))
+            else:
+                self._backoff().success(self)
         finally:
             transaction.abort()
             zope.security.management.endInteraction()
 
+    def _backoff(self):
+        """Return the policy for delaying retries after ConflictErrors, given
+        by its dotted name in `CONFLICT_BACKOFF` (optional, default:
+        `z3c.celery.backoff.ExponentialBackoff`, the policy of earlier
+        versions; `z3c.celery.backoff.AdaptiveBackoff` is opt-in)."""
+        conf = self.app.conf
+        return _conf_singleton(
+            conf, 'CONFLICT_BACKOFF_POLICY',
+            lambda: celery.utils.imports.symbol_by_name(
+                conf.get('CONFLICT_BACKOFF') or
+                'z3c.celery.backoff.ExponentialBackoff')())
+
+    def _finish_read_only(self):
+        """Finish the transaction of a read-only task without a commit.
+
+        Queued tasks are still sent, which requires a commit if the celery
+        session is the only data manager that joined the transaction.
+        """
+        # The transaction package offers no public API to list the data
+        # managers that joined a transaction.
+        resources = transaction.get()._resources
+        modified = [x for x in resources
+                    if not isinstance(x, CeleryDataManager)]
+        if modified:
+            transaction.abort()
+            raise ReadOnlyError(
+                'Read-only task %s modified %r' % (self.name, modified))
+        if resources:
+            with phase(self, 'commit'):
+                transaction.commit()
+
+    def _get_principal(self, principal_id):
+        """Return the principal, using a per-process cache if
+        `PRINCIPAL_CACHE_TTL` (seconds) is set. Its size is limited by
+        `PRINCIPAL_CACHE_SIZE` (optional, default: 1000).
+
+        Only use the cache if principals do not belong to a ZODB connection.
+        """
+        conf = self.app.conf
+        ttl = conf.get('PRINCIPAL_CACHE_TTL')
+        if not ttl:
+            return get_principal(principal_id)
+        cache = _conf_singleton(
+            conf, 'PRINCIPAL_CACHE', lambda: PrincipalCache(
+                ttl, conf.get('PRINCIPAL_CACHE_SIZE') or 1000))
+        return cache.get(principal_id)
+
     @contextlib.contextmanager
     def configure_zope(self):
         old_site = zope.component.hooks.getSite()
         db = self.app.conf.get('ZODB')
-        connection = db.open()
-        root_folder = connection.root()[
-            zope.app.publication.zopepublication.ZopePublication.root_name]
-        zope.component.hooks.setSite(root_folder)
+        reuse_connection = self.app.conf.get('REUSE_ZODB_CONNECTION')
+        with phase(self, 'zope'):
+            if reuse_connection:
+                connection, root_folder = self._reused_connection(db)
+            else:
+                connection = db.open()
+                root_folder = connection.root()[
+                    zope.app.publication.zopepublication.ZopePublication
+                    .root_name]
+            zope.component.hooks.setSite(root_folder)
         try:
             yield
         finally:
-            connection.close()
+            if not reuse_connection:
+                connection.close()
             zope.component.hooks.setSite(old_site)
 
+    def _reused_connection(self, db):
+        """Return the connection of the current thread and its root folder.
+
+        The connection stays open (and keeps its object cache) across tasks,
+        so it only has to catch up with changes made by other connections.
+        """
+        state = _worker_state.__dict__
+        if state.get('db') is not db or state['connection'].opened is None:
+            connection = db.open()
+            state.update(
+                db=db, connection=connection, root_folder=connection.root()[
+                    zope.app.publication.zopepublication.ZopePublication
+                    .root_name])
+        else:
+            state['connection'].newTransaction(None)
+        return state['connection'], state['root_folder']
+
     _eager_use_session_ = False  # Hook for tests
 
+    # Pack calls without task_id and options into chunk messages of at most
+    # this many calls each (optional, default: `None` to send one message per
+    # call). The AsyncResult of a chunked call is never fulfilled.
+    chunk_size = None
+
+    # Send only one message for calls with the same arguments and principal
+    # in one transaction, if they have no task_id and options (optional,
+    # default: `False`). Repeated calls return the AsyncResult of the first.
+    coalesce = False
+
+    # Do not commit the transaction of the task in the worker (optional,
+    # default: `False`). Modifying anything raises a ReadOnlyError,
+    # ConflictErrors are not retried.
+    read_only = False
+
+    # Run the calls of a chunk message (see `chunk_size`) in one transaction
+    # per principal (optional, default: `False`).
+    chunk_batch = False
+
+    # Objects to prefetch in bulk before the task runs in the worker
+    # (optional, default: `None`), see `z3c.celery.prefetch.resolve`. Either
+    # a sequence or a callable which is called like a method with the
+    # arguments of the task and returns the sequence.
+    prefetch = None
+
+    # Persistent objects the result of the task depends on (optional,
+    # default: `None`), given like `prefetch`. If none of them changed since
+    # the task ran with the same arguments and principal, the worker skips
+    # running it and returns the cached result, see `z3c.celery.memoize`.
+    # The result has to be JSON serializable.
+    memoize = None
+
+    # Name of the task argument whose value is the affinity key of a call
+    # (optional, default: `None`). Calls with the same key are sent to the
+    # same of the `AFFINITY_QUEUES` partition queues.
+    affinity = None
+
     def apply_async(self, args=None, kw=None, task_id=None, **options):
-        self._assert_json_serializable(args, kw)
+        if self.affinity is not None and 'queue' not in options:
+            queue = self._affinity_queue(args, kw)
+            if queue is not None:
+                options['queue'] = queue
+        chunked = self.chunk_size and task_id is None and not options
+        coalesced = self.coalesce and task_id is None and not options
         if kw is None:
             kw = {}
         if task_id is None:
@@ -250,6 +680,8 @@ class TransactionAwareTask(celery.Task):
         # XXX These actually rather belongs into CelerySession, but that would
         # get mechanically complicated.
         if self.app.conf['task_always_eager'] and not self._eager_use_session_:
+            # Fail early on arguments which could not be sent to a worker.
+            self._serialize_arguments(args, kw)
             self.__call__(*args, **kw)
         elif self.name == 'celery.ping':
             # Part of celery.contrib.testing setup, we need to perform this
@@ -259,13 +691,94 @@ class TransactionAwareTask(celery.Task):
             # Hook so tests can force __call__ to use run_in_worker even when
             # always_eager is True, by passing in this kw explicitly.
             kw.setdefault('_run_asynchronously_', True)
-            celery_session.add_call(
-                super().apply_async, args, kw, task_id, **options)
+            if coalesced:
+                # The payload is the key of coalesced calls, so it must not
+                # depend on the order of the keyword arguments.
+                kw = dict(sorted(kw.items()))
+            # Serializing right away fails early, i.e. when `delay()` is
+            # called, on arguments which cannot be sent to the worker. The
+            # session keeps only the serialized form, which is used as message
+            # body on commit.
+            payload = self._serialize_arguments(args, kw)
+            if coalesced:
+                first_task_id = celery_session.coalesce(
+                    (self.name, payload), task_id)
+                if first_task_id != task_id:
+                    return self.AsyncResult(first_task_id)
+            if chunked:
+                celery_session.add_chunked_call(
+                    self._apply_chunk, payload, self.chunk_size)
+            else:
+                celery_session.add_call(
+                    self._apply_serialized, task_id, payload, **options)
         return self.AsyncResult(task_id)
 
-    def _assert_json_serializable(self, *args, **kw):
-        json.dumps(args)
-        json.dumps(kw)
+    def _affinity_queue(self, args, kw):
+        """Return the partition queue for the affinity key of the call.
+
+        The number of partition queues is set by `AFFINITY_QUEUES` in the
+        celery config, the calls are not partitioned if it is not set.
+        """
+        count = self.app.conf.get('AFFINITY_QUEUES')
+        if not count:
+            return None
+        key = self._affinity_key(args, kw)
+        if key is None:
+            return None
+        return affinity_queues(self.app)[
+            zlib.crc32(str(key).encode('utf-8')) % count]
+
+    def _affinity_key(self, args, kw):
+        """Return the value of the `affinity` argument of the call."""
+        kw = {key: value for key, value in (kw or {}).items()
+              if not (key.startswith('_') and key.endswith('_'))}
+        try:
+            arguments = inspect.signature(self.run).bind_partial(
+                *(args or ()), **kw).arguments
+        except TypeError:
+            return None
+        return arguments.get(self.affinity)
+
+    def _serialize_arguments(self, args, kw):
+        """Serialize args and kw to JSON bytes using the encoder configured
+        in `JSON_ENCODER` (dotted name, optional, default: `json.dumps`)."""
+        return z3c.celery.serialization.dumps(
+            [args or (), kw], self.app.conf.get('JSON_ENCODER'))
+
+    def _deserialize_arguments(self, payload):
+        args, kw = json.loads(payload)
+        return tuple(args), kw
+
+    def _apply_serialized(self, task_id, payload, **options):
+        """Send the task with the serialized `[args, kw]` in `payload` as
+        message body.
+
+        Task routers get the actual arguments, so tasks are sent the regular
+        way if `task_routes` is set. `before_task_publish` receivers see empty
+        args and kwargs in the body, the arguments are in `body[0].payload`.
+        """
+        conf = self.app.conf
+        serializer = self.serializer or conf['task_serializer']
+        if (conf['task_always_eager'] or conf['task_protocol'] != 2 or
+                serializer != 'json' or 'serializer' in options or
+                conf['task_routes']):
+            args, kw = self._deserialize_arguments(payload)
+            return super().apply_async(args, kw, task_id=task_id, **options)
+        amqp = self.app.amqp
+        argsrepr, kwargsrepr = z3c.celery.serialization.reprs(
+            payload, amqp.argsrepr_maxsize, amqp.kwargsrepr_maxsize)
+        options.setdefault('argsrepr', argsrepr)
+        options.setdefault('kwargsrepr', kwargsrepr)
+        return super().apply_async(
+            z3c.celery.serialization.Arguments(payload), {}, task_id=task_id,
+            serializer=z3c.celery.serialization.SERIALIZER, **options)
+
+    def _apply_chunk(self, payloads, **options):
+        payload = b''.join([
+            b'[[],{"_chunk_":[', b','.join(payloads),
+            b'],"_run_asynchronously_":true}]'])
+        return self._apply_serialized(
+            celery.utils.gen_unique_id(), payload, **options)
 
     def _get_current_principal_id(self):
         interaction = zope.security.management.queryInteraction()
@@ -326,3 +839,10 @@ class TransactionAwareTask(celery.Task):
 CELERY = celery.Celery(
     __name__, task_cls=TransactionAwareTask, loader=ZopeLoader,
     strict_typing=False)
+
+
+@celery.shared_task(name='z3c.celery.run_after_abort')
+def run_after_abort(callback, args, kw):
+    """Run the callback of a HandleAfterAbort exception, which was deferred
+    because of a ConflictError."""
+    celery.utils.imports.symbol_by_name(callback)(*args, **kw)
@@ -0,0 +1,135 @@
+"""Record which persistent objects cause ConflictErrors in which tasks.
+
+Dump the hotspots recorded by the worker processes with::
+
+    $ python -m z3c.celery.conflicts /path/to/CONFLICT_HOTSPOTS [--top=20]
+"""
+import argparse
+import celery.utils.dispatch
+import glob
+import json
+import os
+import os.path
+import sys
+import threading
+
+
+# Sent when a task run in the worker raises a ConflictError (or another
+# `transaction.interfaces.TransientError`) with the keyword arguments
+# `task_name`, `stage` (`run` or `commit`), `oid` (hex string or None),
+# `class_name` (or None) and `retries` (of the task so far).
+# The sender is the task.
+task_conflict = celery.utils.dispatch.Signal(name='task_conflict')
+
+
+def record(task, error, stage):
+    """Send `task_conflict` for the ConflictError `error`."""
+    if not task_conflict.receivers:
+        return
+    oid = getattr(error, 'oid', None)
+    if oid is not None:
+        oid = '0x%02x' % int.from_bytes(oid, 'big')
+    task_conflict.send(
+        sender=task, task_name=task.name, stage=stage, oid=oid,
+        class_name=getattr(error, 'class_name', None),
+        retries=task.request.retries or 0)
+
+
+class Hotspots:
+    """Count the conflicts per task name, object and stage."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, sender, task_name, stage, oid, class_name, retries,
+                 **kw):
+        key = (task_name, oid, class_name, stage)
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                data = self._data[key] = dict(count=0, max_retries=0)
+            data['count'] += 1
+            data['max_retries'] = max(data['max_retries'], retries)
+
+    def connect(self):
+        task_conflict.connect(self, weak=False, dispatch_uid=id(self))
+
+    def disconnect(self):
+        task_conflict.disconnect(self, dispatch_uid=id(self))
+
+    def report(self):
+        """Return the hotspots as list of dicts, most conflicts first."""
+        with self._lock:
+            result = [
+                dict(task_name=task_name, oid=oid, class_name=class_name,
+                     stage=stage, **data)
+                for (task_name, oid, class_name, stage), data
+                in self._data.items()]
+        return _sorted(result)
+
+    def dump(self, directory):
+        """Write the report of this process to `directory`, if there were
+        any conflicts."""
+        report = self.report()
+        if not report:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'conflicts-%s.json' % os.getpid())
+        with open(path, 'w') as f:
+            json.dump(report, f)
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _sorted(hotspots):
+    return sorted(hotspots, key=lambda x: (
+        -x['count'], x['task_name'], x['oid'] or '', x['stage']))
+
+
+def load(directory):
+    """Return the hotspots of all processes dumped into `directory`, most
+    conflicts first."""
+    result = {}
+    for path in glob.glob(os.path.join(directory, 'conflicts-*.json')):
+        with open(path) as f:
+            for item in json.load(f):
+                key = (item['task_name'], item['oid'], item['class_name'],
+                       item['stage'])
+                data = result.get(key)
+                if data is None:
+                    result[key] = dict(item)
+                    continue
+                data['count'] += item['count']
+                data['max_retries'] = max(
+                    data['max_retries'], item['max_retries'])
+    return _sorted(result.values())
+
+
+# Default recorder, connected by the ZopeLoader if `CONFLICT_HOTSPOTS` (the
+# directory to dump to) is set in the celery config.
+hotspots = Hotspots()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Show the objects which caused the most ConflictErrors.')
+    parser.add_argument(
+        'directory', help='Directory given as CONFLICT_HOTSPOTS')
+    parser.add_argument('--top', type=int, default=20)
+    options = parser.parse_args(argv)
+    line = '{count:>8} {max_retries:>7} {stage:<6} {oid:<18} {class_name} ' \
+        '{task_name}\n'
+    sys.stdout.write(line.format(
+        count='count', max_retries='retries', stage='stage', oid='oid',
+        class_name='class', task_name='task'))
+    for item in load(options.directory)[:options.top]:
+        sys.stdout.write(line.format(**dict(
+            item, oid=item['oid'] or '-',
+            class_name=item['class_name'] or '-')))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import collections
 import contextlib
 import os
 import os.path
+import persistent
 import plone.testing.zca
 import pytest
 import tempfile
@@ -10,6 +11,9 @@ import transaction
 import z3c.celery
 import z3c.celery.celery
 import z3c.celery.testing
+import ZODB
+import zope.app.publication.zopepublication
+import zope.component
 import zope.principalregistry.principalregistry
 import zope.security.management
 import zope.security.testing
@@ -93,9 +97,32 @@ def eager_celery_app(zope_conf):
     with celery.contrib.testing.app.setup_default_app(app):
         app.set_current()
         yield app
+    for key in set(app.conf) - set(old_conf):
+        del app.conf[key]
     app.conf.update(old_conf)
 
 
+class Site(persistent.Persistent):
+    """Minimal root folder which uses the global component registry."""
+
+    def getSiteManager(self):
+        return zope.component.getGlobalSiteManager()
+
+
+@pytest.fixture(scope='function')
+def zodb(eager_celery_app):
+    """Provide an in-memory ZODB with a root folder as `ZODB` of the app."""
+    db = ZODB.DB(None)
+    with db.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name] = (
+                Site())
+    eager_celery_app.conf['ZODB'] = db
+    yield db
+    z3c.celery.celery._worker_state.__dict__.clear()
+    db.close()
+
+
 @pytest.fixture(scope='session')
 def celery_config(zope_conf):
     return _celery_config(zope_conf)
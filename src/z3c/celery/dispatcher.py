@@ -0,0 +1,118 @@
+"""Process-wide dispatcher which publishes the tasks of committed
+transactions in a background thread.
+
+The threads committing the transactions only hand over their tasks, so they
+do not have to wait for the broker. The dispatcher keeps one producer (and
+thus one broker connection) for the tasks of all threads. Kombu has no API to
+publish several messages at once, so each task is still a message of its own.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import weakref
+
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Apps with a dispatcher in this process, see `_stop_dispatchers`.
+_apps = weakref.WeakSet()
+
+
+class Dispatcher(threading.Thread):
+    """Publish the calls handed over by `submit` in a background thread.
+
+    If the producer cannot be acquired (e.g. the broker is not reachable),
+    the dispatcher retries every `retry_interval` seconds, the calls keep
+    waiting in the queue. A new dispatcher can take over the `queue` of one
+    whose thread died by getting it as `pending`.
+    """
+
+    daemon = True
+    retry_interval = 1
+
+    def __init__(self, app, pending=None):
+        super().__init__(name='z3c.celery.dispatcher')
+        self.app = app
+        self.queue = queue.Queue() if pending is None else pending
+        self.pid = os.getpid()
+        self._stopping = threading.Event()
+
+    def submit(self, calls):
+        """Hand over a list of `(method, args, kw)` to be published."""
+        self.queue.put(calls)
+
+    def run(self):
+        while True:
+            try:
+                with self.app.producer_or_acquire() as producer:
+                    self._publish(producer)
+                    return
+            except Exception:
+                log.error('Cannot connect to the broker, retrying in %s '
+                          'seconds', self.retry_interval, exc_info=True)
+            if self._stopping.wait(self.retry_interval):
+                # Without the None put into the queue by `stop`.
+                log.error('Stopped without a broker connection, %s '
+                          'transactions were not published.',
+                          self.queue.qsize() - 1)
+                return
+
+    def _publish(self, producer):
+        """Publish the submitted calls until the dispatcher is stopped."""
+        while True:
+            calls = self.queue.get()
+            if calls is None:
+                return
+            for method, args, kw in calls:
+                try:
+                    method(*args, producer=producer, **kw)
+                except Exception:
+                    # The transaction is already committed, so there is
+                    # nobody to report the error to.
+                    log.error('Publishing %s failed', method.__self__.name,
+                              exc_info=True)
+
+    def stop(self):
+        """Publish the remaining calls and stop the thread."""
+        self._stopping.set()
+        self.queue.put(None)
+        self.join()
+
+
+def get_dispatcher(app):
+    """Return the running dispatcher of `app`, starting it if necessary."""
+    with _lock:
+        dispatcher = app.conf.get('DISPATCHER')
+        if dispatcher is None or not dispatcher.is_alive():
+            # Take over the calls of a dispatcher whose thread died, but not
+            # the ones of the parent process after a fork, which it publishes
+            # itself.
+            pending = None
+            if dispatcher is not None and dispatcher.pid == os.getpid():
+                pending = dispatcher.queue
+            dispatcher = app.conf['DISPATCHER'] = Dispatcher(app, pending)
+            dispatcher.start()
+            _apps.add(app)
+        return dispatcher
+
+
+def stop_dispatcher(app):
+    """Stop the dispatcher of `app` (if any) after publishing the remaining
+    calls."""
+    with _lock:
+        dispatcher = app.conf.get('DISPATCHER')
+        if dispatcher is None:
+            return
+        app.conf['DISPATCHER'] = None
+    if dispatcher.is_alive():
+        dispatcher.stop()
+
+
+@atexit.register
+def _stop_dispatchers():
+    # Do not lose the calls which are still waiting at exit.
+    for app in list(_apps):
+        stop_dispatcher(app)
@@ -1,5 +1,7 @@
 from celery.contrib.testing.app import TestApp, setup_default_app
 from celery.contrib.testing.worker import start_worker
+import atexit
+import os
 import plone.testing
 import z3c.celery
 
@@ -18,6 +20,56 @@ class EagerLayer(plone.testing.Layer):
 EAGER_LAYER = EagerLayer()
 
 
+def xdist_worker():
+    """Return the name of the pytest-xdist worker running the tests (e.g.
+    `gw0`) or None if the tests do not run in parallel."""
+    return os.environ.get('PYTEST_XDIST_WORKER') or None
+
+
+# Transports supporting the `global_keyprefix` transport option.
+KEYPREFIX_TRANSPORTS = ('redis', 'rediss', 'sentinel')
+
+
+def _isolate_config(config):
+    """Return `config` with the keys of the broker prefixed by the name of
+    the xdist worker, so parallel test runs use separate queues.
+
+    Only the redis transport supports prefixing the keys, other brokers raise
+    a ValueError.
+    """
+    worker = xdist_worker()
+    if worker is None:
+        return config
+    transport = (config.get('broker_url') or 'amqp://').split('://')[0]
+    if transport not in KEYPREFIX_TRANSPORTS:
+        raise ValueError(
+            'Cannot isolate the %r broker for pytest-xdist worker %s, only '
+            'redis supports it. Set the `celery_xdist_isolation` resource to '
+            'False to share the broker between the workers.' % (
+                transport, worker))
+    options = dict(config.get('broker_transport_options') or {})
+    options['global_keyprefix'] = '%s%s:' % (
+        options.get('global_keyprefix') or '', worker)
+    return dict(config, broker_transport_options=options)
+
+
+# Worker kept running by EndToEndLayer with `celery_worker_reuse` between
+# layers: (key, app, worker fixture) or None
+_reusable_worker = None
+
+
+def _stop_reusable_worker():
+    global _reusable_worker
+    if _reusable_worker is None:
+        return
+    worker_fixture = _reusable_worker[-1]
+    _reusable_worker = None
+    worker_fixture.__exit__(None, None, None)
+
+
+atexit.register(_stop_reusable_worker)
+
+
 class EndToEndLayer(plone.testing.Layer):
     """Run celery end to end tests in a plone.testing Layer.
 
@@ -26,14 +78,50 @@ class EndToEndLayer(plone.testing.Layer):
     * `celery_config`: dict of config options for the celery app
     * `celery_parameters`: dict of parameters used to instantiate Celery
     * `celery_worker_parameters`: dict of parameters used to instantiate
-       celery workers
+       celery workers, e.g. `pool` (default: `prefork`) and `concurrency`
     * `celery_includes`: list of dotted names to load the tasks in the worker
+
+    Provides the resource `celery_app` (the app used by the worker).
+
+    Optional resources:
+
+    * `celery_worker_reuse`: keep the worker running after tearDown, so the
+       next layer with the same resources can use it instead of starting a
+       new one (default: False)
+    * `celery_xdist_isolation`: prefix the keys of the broker by the name of
+       the pytest-xdist worker when running in parallel (default: True)
     """
 
     def setUp(self):
+        config = self['celery_config']
+        if self._get_optional('celery_xdist_isolation', True):
+            config = _isolate_config(config)
+        worker_parameters = dict(
+            {'pool': 'prefork'}, **self['celery_worker_parameters'])
+        reuse = self._get_optional('celery_worker_reuse', False)
+        key = repr((sorted(config.items()),
+                    sorted(self['celery_parameters'].items()),
+                    sorted(worker_parameters.items()),
+                    list(self['celery_includes'])))
+
+        global _reusable_worker
+        if _reusable_worker is not None and (
+                not reuse or _reusable_worker[0] != key):
+            _stop_reusable_worker()
+        if _reusable_worker is not None:
+            key, celery_app, worker_fixture = _reusable_worker
+            _reusable_worker = None
+            self['celery_app'] = celery_app
+            self['celery_app_fixture'] = setup_default_app(celery_app)
+            self['celery_app_fixture'].__enter__()
+            self['celery_worker_fixture'] = worker_fixture
+            self['celery_reuse_key'] = key
+            return
+
         celery_app = TestApp(
             set_as_current=False, enable_logging=True,
-            config=self['celery_config'], **self['celery_parameters'])
+            config=config, **self['celery_parameters'])
+        self['celery_app'] = celery_app
         self['celery_app_fixture'] = setup_default_app(celery_app)
         self['celery_app_fixture'].__enter__()
 
@@ -41,11 +129,29 @@ class EndToEndLayer(plone.testing.Layer):
             celery_app.loader.import_task_module(module)
 
         self['celery_worker_fixture'] = start_worker(
-            celery_app, pool='prefork', **self['celery_worker_parameters'])
+            celery_app, **worker_parameters)
         self['celery_worker_fixture'].__enter__()
+        if reuse:
+            self['celery_reuse_key'] = key
 
     def tearDown(self):
+        global _reusable_worker
+        celery_app = self['celery_app']
+        del self['celery_app']
         self['celery_app_fixture'].__exit__(None, None, None)
         del self['celery_app_fixture']
-        self['celery_worker_fixture'].__exit__(None, None, None)
+        if 'celery_reuse_key' in self:
+            _stop_reusable_worker()
+            _reusable_worker = (
+                self['celery_reuse_key'], celery_app,
+                self['celery_worker_fixture'])
+            del self['celery_reuse_key']
+        else:
+            self['celery_worker_fixture'].__exit__(None, None, None)
         del self['celery_worker_fixture']
+
+    def _get_optional(self, name, default):
+        try:
+            return self[name]
+        except KeyError:
+            return default
@@ -1,17 +1,62 @@
+import ZConfig
+import billiard.pool
+import celery.concurrency
 import celery.concurrency.asynpool
+import celery.concurrency.prefork
 import celery.loaders.app
 import celery.signals
 import celery.utils.collections
+import gc
+import logging
 import logging.config
 import types
+import z3c.celery.conflicts
+import z3c.celery.logging
+import z3c.celery.serialization
+import z3c.celery.timing
+import os
 import os.path
+import sys
+import zope.app.appsetup.appsetup
+import zope.app.appsetup.product
 import zope.app.wsgi
+import zope.event
+import zope.processlifetime
+
+
+log = logging.getLogger(__name__)
+# Measurement of the prefork pool, which returns the peak RSS in KiB.
+_peak_rss = billiard.pool.mem_rss
+
+
+def _current_rss():
+    """Return the current (not the peak) resident set size in KiB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        # Not on Linux, fall back to the peak usage.
+        return _peak_rss()
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
 
 
 class ZopeLoader(celery.loaders.app.AppLoader):
     """Sets up the Zope environment in the Worker processes."""
 
+    # Parsed zope.conf if it was loaded in the parent process.
+    zope_options = None
+
     def on_worker_init(self):
+        if self.app.conf.get('PRELOAD_ZOPE'):
+            # Execute the ZCML before the worker processes are forked, so they
+            # share the component registry. Only the database has to be
+            # opened in each worker process.
+            self.zope_options = self._load_zope_conf()
+        self._accept_serializer()
+        # The pool is only known when the worker sends this signal.
+        celery.signals.worker_init.connect(
+            self._set_up_unforked_pool, weak=False, dispatch_uid=id(self))
+
         logging_ini = self.app.conf.get('LOGGING_INI')
         if not logging_ini:
             return
@@ -19,11 +64,17 @@ class ZopeLoader(celery.loaders.app.AppLoader):
         @celery.signals.setup_logging.connect(weak=False)
         def setup_logging(*args, **kw):
             """Make the loglevel finely configurable via a config file."""
+            queued_logging = z3c.celery.logging.queued_logging
+            if queued_logging.started:
+                queued_logging.stop()
             config_file = os.path.abspath(logging_ini)
             logging.config.fileConfig(
                 config_file, dict(
                     __file__=config_file, here=os.path.dirname(config_file)),
                 disable_existing_loggers=False)
+            if self.app.conf.get('QUEUED_LOGGING'):
+                # Write the log records in a background thread.
+                queued_logging.start()
 
         if self.app.conf.get('DEBUG_WORKER'):
             assert self.app.conf.get('worker_pool') == 'solo'
@@ -34,20 +85,144 @@ class ZopeLoader(celery.loaders.app.AppLoader):
             celery.concurrency.asynpool.PROC_ALIVE_TIMEOUT = float(
                 self.app.conf['worker_boot_timeout'])
 
+    def _accept_serializer(self):
+        """Accept the messages sent by `TransactionAwareTask` with the
+        `z3c.celery.json` serializer if the worker accepts JSON, as they are
+        plain JSON."""
+        accept = list(self.app.conf.get('accept_content') or ())
+        if ('json' in accept or 'application/json' in accept) and (
+                z3c.celery.serialization.SERIALIZER not in accept):
+            self.app.conf['accept_content'] = accept + [
+                z3c.celery.serialization.SERIALIZER]
+
+    def _set_up_unforked_pool(self, sender, **kw):
+        """Set up Zope in this process if the pool of the worker does not
+        fork (e.g. `threads`, `gevent` or `solo`), so all tasks run here.
+
+        Each thread (or greenlet) uses its own ZODB connection, site and
+        interaction, so the connection pool of the database is enlarged to
+        the concurrency of the worker.
+        """
+        if getattr(sender, 'app', None) is not self.app:
+            return
+        pool_cls = celery.concurrency.get_implementation(sender.pool_cls)
+        if issubclass(pool_cls, celery.concurrency.prefork.TaskPool):
+            return
+        if 'ZODB' not in self.app.conf:
+            # Not yet set up by `DEBUG_WORKER`.
+            self.on_worker_process_init()
+        db = self.app.conf['ZODB']
+        if sender.concurrency and db.getPoolSize() < sender.concurrency:
+            db.setPoolSize(sender.concurrency)
+
     def on_worker_process_init(self):
         conf = self.app.conf
-        configfile = conf.get('ZOPE_CONF')
+        if conf.get('TASK_PHASE_HISTOGRAMS'):
+            z3c.celery.timing.histograms.connect()
+            celery.signals.worker_process_shutdown.connect(
+                self._log_phase_histograms, weak=False)
+        if conf.get('CONFLICT_HOTSPOTS'):
+            z3c.celery.conflicts.hotspots.connect()
+            celery.signals.worker_process_shutdown.connect(
+                self._dump_conflict_hotspots, weak=False)
+        if z3c.celery.logging.queued_logging.started:
+            celery.signals.worker_process_shutdown.connect(
+                self._stop_queued_logging, weak=False)
+        if self.zope_options is not None:
+            db = zope.app.appsetup.appsetup.multi_database(
+                self.zope_options.databases)[0][0]
+            zope.event.notify(zope.processlifetime.DatabaseOpened(db))
+        else:
+            db = zope.app.wsgi.config(self._zope_conf())
+        conf['ZODB'] = db
+        if conf.get('MINIMIZE_CACHE_BEFORE_RECYCLE'):
+            # The prefork pool calls this after each task and recycles the
+            # process if the result exceeds `worker_max_memory_per_child`.
+            billiard.pool.mem_rss = self._memory_usage
+
+    def _memory_usage(self):
+        """Return the memory usage of this process in KiB, minimizing the
+        ZODB caches first if it is too high.
+
+        The usage is too high if the current RSS exceeds
+        `worker_max_memory_per_child` or the number of objects in the ZODB
+        caches exceeds `MAX_CACHE_SIZE_PER_CHILD` (optional). If the caches
+        are still too large after minimizing them, the returned usage makes
+        the pool recycle the process.
+        """
+        conf = self.app.conf
+        db = conf['ZODB']
+        max_rss = conf.get('worker_max_memory_per_child') or 0
+        max_cache_size = conf.get('MAX_CACHE_SIZE_PER_CHILD') or 0
+        rss = _current_rss()
+        if not ((max_rss and rss > max_rss) or
+                (max_cache_size and db.cacheSize() > max_cache_size)):
+            return rss
+        db.cacheMinimize()
+        gc.collect()
+        rss = _current_rss()
+        cache_size = db.cacheSize()
+        if max_cache_size and cache_size > max_cache_size:
+            log.warning('%s objects in the ZODB caches after minimizing '
+                        'them, recycling process.', cache_size)
+            return sys.maxsize
+        if max_rss and rss > max_rss:
+            log.warning('Using %s KiB after minimizing the ZODB caches, '
+                        'recycling process.', rss)
+        return rss
+
+    def _zope_conf(self):
+        configfile = self.app.conf.get('ZOPE_CONF')
         if not configfile:
             raise ValueError(
                 'Celery setting ZOPE_CONF not set, '
                 'check celery worker config.')
+        return configfile
 
-        db = zope.app.wsgi.config(configfile)
-        conf['ZODB'] = db
+    def _load_zope_conf(self):
+        """Load zope.conf and execute the ZCML like zope.app.wsgi.config(),
+        but without opening the database.
+
+        Returns the parsed zope.conf.
+        """
+        schema = ZConfig.loadSchema(os.path.join(
+            os.path.dirname(zope.app.appsetup.appsetup.__file__),
+            'schema', 'schema.xml'))
+        options, handlers = ZConfig.loadConfig(schema, self._zope_conf())
+        if options.path:
+            sys.path[:0] = [os.path.abspath(p) for p in options.path]
+        zope.app.appsetup.product.setProductConfigurations(
+            options.product_config)
+        options.eventlog()
+        for logger in options.loggers:
+            logger()
+        features = ('devmode',) if options.devmode else ()
+        zope.app.appsetup.appsetup.config(
+            options.site_definition, features=features)
+        return options
+
+    def _log_phase_histograms(self, **kw):
+        report = z3c.celery.timing.histograms.report()
+        if report:
+            log.info('Task phase histograms: %s', report)
+
+    def _dump_conflict_hotspots(self, **kw):
+        z3c.celery.conflicts.hotspots.dump(self.app.conf['CONFLICT_HOTSPOTS'])
 
     def on_worker_shutdown(self):
         if 'ZODB' in self.app.conf:
             self.app.conf['ZODB'].close()
+        if self.app.conf.get('TASK_PHASE_HISTOGRAMS'):
+            # Tasks ran in this process if the pool does not fork.
+            self._log_phase_histograms()
+        if self.app.conf.get('CONFLICT_HOTSPOTS'):
+            # Tasks ran in this process if the pool does not fork.
+            self._dump_conflict_hotspots()
+        # Write the queued log records, including the ones above.
+        self._stop_queued_logging()
+
+    def _stop_queued_logging(self, **kw):
+        z3c.celery.logging.queued_logging.stop()
 
     def read_configuration(self):
         """Read configuration from either
@@ -1,18 +1,145 @@
-from celery._state import get_current_task
+import celery.signals
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
 import zope.exceptions.log
 
 
+# `(task_id, task_name)` of the task running in the current thread, set by the
+# task_prerun and task_postrun signals, so formatting a log record does not
+# have to look up the current task.
+_task_context = contextvars.ContextVar(
+    'z3c.celery.task_context', default=('', ''))
+# Tokens to restore the outer task context after a nested (eager) task.
+_tokens = threading.local()
+
+
+@celery.signals.task_prerun.connect(weak=False, dispatch_uid=__name__)
+def _set_task_context(task_id=None, task=None, **kw):
+    token = _task_context.set((task_id, task.name))
+    _tokens.__dict__.setdefault('stack', []).append(token)
+
+
+@celery.signals.task_postrun.connect(weak=False, dispatch_uid=__name__)
+def _reset_task_context(**kw):
+    stack = getattr(_tokens, 'stack', None)
+    if stack:
+        _task_context.reset(stack.pop())
+
+
+@contextlib.contextmanager
+def context(task):
+    """Set the task context to `task` for tasks which are called directly
+    instead of being traced by the worker (which sends the signals)."""
+    token = _task_context.set((task.request.id, task.name))
+    try:
+        yield
+    finally:
+        _task_context.reset(token)
+
+
+def task_context():
+    """Return `(task_id, task_name)` of the current task or empty strings."""
+    return _task_context.get()
+
+
+class TaskContextFilter(logging.Filter):
+    """Stamp `task_id` and `task_name` on log records when they are created.
+
+    Use it on handlers which format records in another thread (e.g. behind a
+    `logging.handlers.QueueHandler`) or to make the values available to
+    formatters other than the ones below.
+    """
+
+    def filter(self, record):
+        # Records put into the queue of `QueuedLogging` are already stamped,
+        # the listener thread has no task context.
+        if 'task_id' not in record.__dict__:
+            record.task_id, record.task_name = _task_context.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Put log records into a queue in this process without formatting them,
+    so the handlers behind the listener format them with their own
+    formatters (including the traceback)."""
+
+    def prepare(self, record):
+        if 'task_id' not in record.__dict__:
+            record.task_id, record.task_name = _task_context.get()
+        # The arguments might change until the listener formats the record.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class QueuedLogging:
+    """Write the log records of the configured loggers in a background thread,
+    so logging never blocks the tasks.
+
+    `start` replaces the handlers of each logger by a `QueueHandler`, the
+    original handlers are called by a `QueueListener` thread. After a fork
+    the child process gets new queues and listener threads. `stop` writes
+    the queued records and restores the original handlers.
+    """
+
+    def __init__(self):
+        # [logger, original handlers, QueueHandler, QueueListener]
+        self._queued = []
+
+    @property
+    def started(self):
+        return bool(self._queued)
+
+    def start(self):
+        for logger in _configured_loggers():
+            handlers = [h for h in logger.handlers
+                        if not isinstance(h, _QueueHandler)]
+            if not handlers:
+                continue
+            handler = _QueueHandler(queue.SimpleQueue())
+            logger.handlers = [handler]
+            self._queued.append(
+                [logger, handlers, handler, self._listen(handler, handlers)])
+
+    def stop(self):
+        queued, self._queued = self._queued, []
+        for logger, handlers, handler, listener in queued:
+            logger.handlers = handlers
+            listener.stop()
+
+    def _listen(self, handler, handlers):
+        listener = logging.handlers.QueueListener(
+            handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        return listener
+
+    def _after_fork(self):
+        # The listener threads do not exist in the child process and the
+        # records in the copied queues are written by the parent process.
+        for entry in self._queued:
+            logger, handlers, handler, listener = entry
+            handler.queue = queue.SimpleQueue()
+            entry[3] = self._listen(handler, handlers)
+
+
+def _configured_loggers():
+    yield logging.getLogger()
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        if isinstance(logger, logging.Logger):
+            yield logger
+
+
 class TaskId:
 
     def format(self, record):
-        task = get_current_task()
-        if task:
-            record.__dict__.update(
-                task_id=task.request.id,
-                task_name=task.name)
-        else:
-            record.__dict__.setdefault('task_name', '')
-            record.__dict__.setdefault('task_id', '')
+        if 'task_id' not in record.__dict__:
+            record.task_id, record.task_name = _task_context.get()
         return super().format(record)
 
 
@@ -25,6 +152,20 @@ class TaskFormatter(TaskId, zope.exceptions.log.Formatter):
     """
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _orjson_dumps(obj, default=None, **kw):
+    """Serialize a log record using orjson, ignoring options which are
+    specific to the `json` module."""
+    return orjson.dumps(
+        obj, default=default or str,
+        option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
 try:
     import pythonjsonlogger.jsonlogger
 except ImportError:
@@ -32,3 +173,18 @@ except ImportError:
 else:
     class JsonFormatter(TaskId, pythonjsonlogger.jsonlogger.JsonFormatter):
         pass
+
+    class FastJsonFormatter(JsonFormatter):
+        """JsonFormatter which serializes using `orjson` if it is installed.
+        """
+
+        def __init__(self, *args, **kw):
+            kw.setdefault(
+                'json_serializer',
+                json.dumps if orjson is None else _orjson_dumps)
+            super().__init__(*args, **kw)
+
+
+# Used by the ZopeLoader if `QUEUED_LOGGING` is set in the celery config.
+queued_logging = QueuedLogging()
+os.register_at_fork(after_in_child=queued_logging._after_fork)
@@ -0,0 +1,134 @@
+"""Caches for the results of tasks which declare `memoize`.
+
+A task result is cached together with the serials (`_p_serial`) of the
+persistent objects the task declares it depends on. As long as none of these
+objects changed, the worker returns the cached result instead of running the
+task again.
+
+The cache is configured by its dotted name in `MEMOIZE_CACHE` in the celery
+config. It is instantiated once per process with the celery app and has to
+provide:
+
+* `get(key)`: the entry stored for `key` or None
+* `set(key, entry)`: store `entry` (JSON serializable) for `key`
+"""
+import celery.backends.base
+import collections
+import hashlib
+import json
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Keep the `MEMOIZE_MAXSIZE` (optional, default: 1000) most recently
+    used entries in the memory of the worker process."""
+
+    def __init__(self, app):
+        self.maxsize = app.conf.get('MEMOIZE_MAXSIZE') or 1000
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ResultBackendCache:
+    """Share the entries between all workers by storing them in the result
+    backend of the celery app, which has to be a key/value store like redis.
+
+    Entries expire after `MEMOIZE_EXPIRES` seconds (optional, default: the
+    `result_expires` of the app).
+    """
+
+    def __init__(self, app):
+        self.backend = app.backend
+        if not isinstance(
+                self.backend, celery.backends.base.BaseKeyValueStoreBackend):
+            raise ValueError(
+                'MEMOIZE_CACHE %s needs a key/value result backend, got %r.'
+                % (self.__class__.__name__, self.backend))
+        self.expires = app.conf.get('MEMOIZE_EXPIRES')
+        if self.expires is None:
+            self.expires = self.backend.expires
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, entry):
+        self.backend.set(key, json.dumps(entry))
+        if self.expires:
+            self.backend.expire(key, int(self.expires))
+
+
+def key(task, principal_id, payload):
+    """Return the cache key of calling `task` as `principal_id` with the
+    serialized arguments `payload` (bytes)."""
+    return 'z3c.celery.memoize:%s:%s:%s' % (
+        task.name, principal_id, hashlib.sha256(payload).hexdigest())
+
+
+def serials(objects):
+    """Return `[oid, serial]` (as hex strings) of the persistent `objects`,
+    loading the ones which are ghosts."""
+    result = []
+    for obj in objects:
+        obj._p_activate()
+        result.append([obj._p_oid.hex(), obj._p_serial.hex()])
+    return result
+
+
+class Memo:
+    """Cached result of a call of a task for the current `serials` of the
+    objects it depends on.
+
+    `hit` tells whether the cache had a result for these serials, which is
+    then available as `result`.
+    """
+
+    def __init__(self, cache, key, serials):
+        self.cache = cache
+        self.key = key
+        self.serials = serials
+        self.hit = False
+        self.result = None
+        try:
+            entry = cache.get(key)
+        except Exception:
+            log.warning('Cannot read memoized result %s', key, exc_info=True)
+            entry = None
+        if entry is not None and entry[0] == serials:
+            self.hit = True
+            self.result = entry[1]
+
+    def store(self, result):
+        try:
+            self.cache.set(self.key, [self.serials, result])
+        except Exception:
+            log.warning('Cannot memoize result %s', self.key, exc_info=True)
+
+    def store_after_commit(self, committed, result):
+        """After commit hook to store the result of a successful commit."""
+        if committed:
+            self.store(result)
@@ -0,0 +1,234 @@
+"""Outbox to store the messages of a transaction in the ZODB.
+
+Messages are stored by the transaction which created them and published to
+the broker later by a relay, so the commit does not have to wait for the
+broker.
+"""
+import argparse
+import BTrees.OOBTree
+import celery.utils
+import datetime
+import itertools
+import logging
+import persistent
+import threading
+import time
+import transaction
+import ZODB.POSException
+import zope.component.hooks
+
+
+log = logging.getLogger(__name__)
+
+# Keys of the outbox and the relay lease in the ZODB root, see `install`.
+OUTBOX_KEY = 'z3c.celery.outbox'
+LEASE_KEY = 'z3c.celery.outbox.lease'
+
+# Stable tags of the task methods stored in the outbox, so renaming a method
+# does not break messages which are already stored.
+METHODS = {
+    'apply': '_apply_serialized',
+    'chunk': '_apply_chunk',
+}
+TAGS = {method: tag for tag, method in METHODS.items()}
+
+
+class Outbox:
+    """Messages waiting to be published, stored in a BTree in the ZODB root.
+
+    The keys start with a timestamp, so the relay publishes the messages in
+    the order they were stored. Concurrent transactions add different keys,
+    which the BTree can resolve without ConflictErrors.
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def add(self, method, args, kw):
+        """Store the call of `method` of a task, which the relay performs."""
+        countdown = kw.pop('countdown', None)
+        if countdown and not kw.get('eta'):
+            # The message might be published later, keep the time it is due.
+            kw['eta'] = datetime.datetime.now(
+                datetime.timezone.utc) + datetime.timedelta(seconds=countdown)
+        tag = TAGS.get(method.__name__)
+        if tag is None:
+            raise ValueError(
+                'Cannot store %s in the outbox, only %s are supported.' % (
+                    method.__name__, ', '.join(sorted(TAGS))))
+        key = '%020d-%s' % (time.time_ns(), celery.utils.gen_unique_id())
+        self.messages[key] = (method.__self__.name, tag, args, kw)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def relay(self, app, batch_size=1000):
+        """Publish at most `batch_size` messages and remove them from the
+        outbox. Returns the number of published messages.
+
+        The caller has to commit the transaction. If that fails, the messages
+        are published again by the next relay (at-least-once delivery).
+        """
+        keys = list(itertools.islice(self.messages.keys(), batch_size))
+        if not keys:
+            return 0
+        with app.producer_or_acquire() as producer:
+            for key in keys:
+                name, tag, args, kw = self.messages[key]
+                getattr(app.tasks[name], METHODS[tag])(
+                    *args, producer=producer, **kw)
+                del self.messages[key]
+        return len(keys)
+
+
+class Lease(persistent.Persistent):
+    """Lease which allows only one relay at a time to publish the outbox."""
+
+    owner = None
+    expires = 0
+
+    def claim(self, owner, duration):
+        """Claim or renew the lease for `owner` for `duration` seconds.
+        Returns False if another owner holds it."""
+        now = time.time()
+        if self.owner not in (None, owner) and self.expires > now:
+            return False
+        self.owner = owner
+        self.expires = now + duration
+        return True
+
+    def release(self, owner):
+        if self.owner == owner:
+            self.owner = None
+            self.expires = 0
+
+
+def install(db):
+    """Create the outbox and the relay lease in the ZODB root of `db` if they
+    do not exist yet.
+
+    Call this once when setting up the database (e.g. in an evolve step):
+    creating them on first use would make concurrent transactions conflict
+    on the root.
+    """
+    with db.transaction() as connection:
+        root = connection.root()
+        if OUTBOX_KEY not in root:
+            root[OUTBOX_KEY] = BTrees.OOBTree.OOBTree()
+        if LEASE_KEY not in root:
+            root[LEASE_KEY] = Lease()
+
+
+def get_outbox(connection=None):
+    """Return the outbox of `connection` (default: the connection of the
+    current site) or None if there is no connection or the outbox is not
+    installed (see `install`)."""
+    if connection is None:
+        connection = getattr(zope.component.hooks.getSite(), '_p_jar', None)
+        if connection is None:
+            return None
+    messages = connection.root().get(OUTBOX_KEY)
+    if messages is None:
+        return None
+    return Outbox(messages)
+
+
+def relay(app, db, batch_size=1000, lease=60):
+    """Publish all messages in the outbox of `db` in batches of at most
+    `batch_size` messages, each in its own transaction.
+
+    Only one relay publishes at a time: the relay holds a lease in the ZODB
+    for `lease` seconds (renewed with each batch) and does nothing while
+    another one holds it.
+
+    Returns the number of published messages.
+    """
+    manager = transaction.TransactionManager()
+    connection = db.open(manager)
+    owner = celery.utils.gen_unique_id()
+    try:
+        try:
+            with manager:
+                outbox = get_outbox(connection)
+                if outbox is None or not outbox.messages:
+                    # Nothing to do, avoid writing the lease.
+                    return 0
+                claimed = connection.root()[LEASE_KEY].claim(owner, lease)
+        except ZODB.POSException.ConflictError:
+            # Another relay claimed the lease at the same time.
+            claimed = False
+        if not claimed:
+            log.debug('Another relay publishes the outbox.')
+            return 0
+        total = 0
+        try:
+            while True:
+                with manager:
+                    # Renew the lease, so it does not expire while relaying.
+                    if not connection.root()[LEASE_KEY].claim(owner, lease):
+                        break
+                    count = get_outbox(connection).relay(app, batch_size)
+                total += count
+                if count < batch_size:
+                    break
+        finally:
+            with manager:
+                connection.root()[LEASE_KEY].release(owner)
+        return total
+    finally:
+        connection.close()
+
+
+class RelayThread(threading.Thread):
+    """Relay the outbox every `interval` seconds in a background thread.
+
+    The outbox has to be installed, see `install`.
+    """
+
+    daemon = True
+
+    def __init__(self, app, db, interval=1, batch_size=1000):
+        super().__init__(name='z3c.celery.outbox')
+        self.app = app
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                relay(self.app, self.db, self.batch_size)
+            except Exception:
+                log.error('Relaying the outbox failed', exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def main(argv=None):
+    """Relay the outbox of the ZODB configured in the `ZOPE_CONF` of the
+    celery config (see `z3c.celery.loader.ZopeLoader.read_configuration`)."""
+    import z3c.celery
+    import zope.app.wsgi
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    options = parser.parse_args(argv)
+    app = z3c.celery.CELERY
+    app.loader.import_default_modules()
+    db = zope.app.wsgi.config(app.conf['ZOPE_CONF'])
+    install(db)
+    try:
+        while True:
+            relay(app, db, options.batch_size)
+            time.sleep(options.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
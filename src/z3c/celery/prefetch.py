@@ -0,0 +1,56 @@
+import celery.utils.dispatch
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# Sent after a task which declares `prefetch` ran in the worker with the
+# keyword arguments `task_name`, `prefetched` (number of objects which were
+# ghosts and thus prefetched) and `saved` (number of these objects which the
+# task then loaded, i.e. loads which needed no round trip of their own).
+# The sender is the task.
+task_prefetch = celery.utils.dispatch.Signal(name='task_prefetch')
+
+
+def resolve(site, items):
+    """Return the persistent objects for the prefetch `items`.
+
+    Items are OIDs (bytes), persistent objects or paths (str) of objects
+    relative to `site`, whose segments are separated by `/` and looked up via
+    `__getitem__`. Items which cannot be resolved are skipped.
+    """
+    connection = site._p_jar
+    result = []
+    for item in items:
+        try:
+            if isinstance(item, bytes):
+                obj = connection.get(item)
+            elif isinstance(item, str):
+                obj = site
+                for name in item.strip('/').split('/'):
+                    if name:
+                        obj = obj[name]
+            else:
+                obj = item
+        except (KeyError, TypeError, LookupError):
+            log.debug('Cannot prefetch %r', item, exc_info=True)
+            continue
+        if getattr(obj, '_p_oid', None) is not None:
+            result.append(obj)
+    return result
+
+
+def ghosts(objects):
+    """Return the objects whose state is not loaded."""
+    return [x for x in objects if x._p_changed is None]
+
+
+def report(task, prefetched):
+    """Send `task_prefetch` for the `prefetched` objects after the task ran
+    and return the number of saved loads."""
+    saved = len(prefetched) - len(ghosts(prefetched))
+    log.debug('%s: prefetched %s objects, saved %s loads',
+              task.name, len(prefetched), saved)
+    task_prefetch.send(sender=task, task_name=task.name,
+                       prefetched=len(prefetched), saved=saved)
+    return saved
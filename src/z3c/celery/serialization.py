@@ -0,0 +1,79 @@
+import celery.utils.imports
+import functools
+import json
+import kombu.serialization
+import kombu.utils.json
+
+
+# Name of the kombu serializer which knows about `Arguments`. It produces
+# plain JSON, but uses a content type of its own, so registering it does not
+# replace kombu's `json` serializer for messages sent as `application/json`.
+# Workers have to accept it, see `z3c.celery.loader.ZopeLoader`.
+SERIALIZER = 'z3c.celery.json'
+CONTENT_TYPE = 'application/x-z3c-celery+json'
+
+
+class Arguments(tuple):
+    """Empty task args which carry the already serialized `[args, kw]` of a
+    task call in `payload`.
+
+    Used in place of the actual args when sending a task, so `encode` can
+    reuse the payload instead of serializing args and kw again.
+    """
+
+    def __new__(cls, payload):
+        self = super().__new__(cls)
+        self.payload = payload
+        return self
+
+    def __bool__(self):
+        # Celery replaces false-y args with an empty tuple.
+        return True
+
+
+@functools.lru_cache()
+def get_encoder(name=None):
+    """Return the JSON encoder given by its dotted name (e.g. `orjson.dumps`)
+    or `json.dumps` if no name is given."""
+    if not name:
+        return json.dumps
+    return celery.utils.imports.symbol_by_name(name)
+
+
+def dumps(obj, encoder=None):
+    """Serialize `obj` to JSON bytes using the given encoder.
+
+    Raises a TypeError if `obj` is not JSON serializable.
+    """
+    data = get_encoder(encoder)(obj)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data
+
+
+_decoder = json.JSONDecoder()
+
+
+def reprs(payload, args_maxsize, kwargs_maxsize):
+    """Return the args and kwargs of the serialized `[args, kw]` in `payload`
+    as JSON strings, for the `argsrepr` and `kwargsrepr` of the message."""
+    text = payload.decode('utf-8')
+    # Only args is decoded, to find where it ends.
+    end = _decoder.raw_decode(text, 1)[1]
+    kwargs = text[end:-1].lstrip(', ')
+    return text[1:end][:args_maxsize], kwargs[:kwargs_maxsize]
+
+
+def encode(body):
+    """Encode a message body, reusing the payload of `Arguments`."""
+    if (isinstance(body, tuple) and len(body) == 3 and
+            isinstance(body[0], Arguments)):
+        # Task message protocol 2: (args, kwargs, embed), where the payload
+        # already contains args and kwargs.
+        embed = kombu.utils.json.dumps(body[2]).encode('utf-8')
+        return body[0].payload[:-1] + b',' + embed + b']'
+    return kombu.utils.json.dumps(body)
+
+
+kombu.serialization.register(
+    SERIALIZER, encode, kombu.utils.json.loads, content_type=CONTENT_TYPE)
@@ -1,39 +1,147 @@
+import celery
+import contextlib
+import logging
 import threading
 import transaction
+import z3c.celery.dispatcher
+import z3c.celery.outbox
 import zope.interface
 import transaction.interfaces
 
 
+log = logging.getLogger(__name__)
+
+
 class CelerySession(threading.local):
     """Thread local session of data to be sent to Celery."""
 
     def __init__(self):
         self.tasks = []
+        self.chunks = {}
+        self.coalesced = {}
+        self.dispatched = []
         self._needs_to_join = True
 
     def add_call(self, method, *args, **kw):
         self._join_transaction()
         self.tasks.append((method, args, kw))
 
+    def add_chunked_call(self, method, item, chunk_size):
+        """Collect `item` to be sent together with other items of `method`.
+
+        On flush `method` is called once per chunk with a list of at most
+        `chunk_size` items.
+        """
+        self._join_transaction()
+        chunks = self.chunks.setdefault(method, [[]])
+        if len(chunks[-1]) >= chunk_size:
+            chunks.append([])
+        chunks[-1].append(item)
+
+    def coalesce(self, key, value):
+        """Return the value stored for `key` in the current transaction.
+
+        If there is none yet, `value` is stored and returned.
+        """
+        self._join_transaction()
+        return self.coalesced.setdefault(key, value)
+
     def reset(self):
         self.tasks = []
+        self.chunks = {}
+        self.coalesced = {}
+        self.dispatched = []
         self._needs_to_join = True
 
     def _join_transaction(self):
         if not self._needs_to_join:
             return
         dm = CeleryDataManager(self)
-        transaction.get().join(dm)
+        txn = transaction.get()
+        txn.join(dm)
+        txn.addBeforeCommitHook(self._write_outbox)
         self._needs_to_join = False
 
-    def _flush(self):
+    def _add_chunks_to_tasks(self):
+        for method, chunks in self.chunks.items():
+            for chunk in chunks:
+                self.tasks.append((method, (chunk,), {}))
+        self.chunks = {}
+
+    def _write_outbox(self):
+        """Move the calls of tasks whose app has `OUTBOX` set into the outbox
+        in the ZODB, so they are stored by the transaction instead of being
+        sent to the broker."""
+        self._add_chunks_to_tasks()
+        outbox = None
+        remaining = []
         for method, args, kw in self.tasks:
-            method(*args, **kw)
+            if _configured_app(method, 'OUTBOX') is None:
+                remaining.append((method, args, kw))
+                continue
+            if outbox is None:
+                outbox = z3c.celery.outbox.get_outbox()
+            if outbox is None:
+                log.warning('No ZODB connection or no outbox installed, '
+                            'sending %s directly.', method.__self__.name)
+                remaining.append((method, args, kw))
+                continue
+            outbox.add(method, args, kw)
+        self.tasks = remaining
+
+    def _flush(self):
+        self._add_chunks_to_tasks()
+        dispatched = []
+        with contextlib.ExitStack() as stack:
+            producers = {}
+            for method, args, kw in self.tasks:
+                if _configured_app(method, 'BACKGROUND_DISPATCH') is not None:
+                    dispatched.append((method, args, kw))
+                    continue
+                app = _configured_app(method, 'BULK_PUBLISH')
+                if app is not None:
+                    if app not in producers:
+                        producers[app] = stack.enter_context(
+                            app.producer_or_acquire())
+                    kw = dict(kw, producer=producers[app])
+                method(*args, **kw)
         self.reset()
+        # Kept until the transaction is finished, see `_dispatch`.
+        self.dispatched = dispatched
+
+    def _dispatch(self):
+        """Hand over the tasks of apps which have `BACKGROUND_DISPATCH` set to
+        the dispatcher of their app after the transaction is finished."""
+        calls = {}
+        for method, args, kw in self.dispatched:
+            calls.setdefault(_task_app(method), []).append((method, args, kw))
+        self.dispatched = []
+        for app, app_calls in calls.items():
+            z3c.celery.dispatcher.get_dispatcher(app).submit(app_calls)
 
     def __len__(self):
         """Number of tasks in the session."""
-        return len(self.tasks)
+        return len(self.tasks) + sum(
+            len(chunk) for chunks in self.chunks.values() for chunk in chunks)
+
+
+def _task_app(method):
+    """Return the celery app if `method` is a method of a task."""
+    task = getattr(method, '__self__', None)
+    if not isinstance(task, celery.Task):
+        return None
+    return task.app
+
+
+def _configured_app(method, setting):
+    """Return the celery app of `method` if `setting` is set in its config and
+    tasks are not run eagerly."""
+    app = _task_app(method)
+    if app is None or not app.conf.get(setting):
+        return None
+    if app.conf['task_always_eager']:
+        return None
+    return app
 
 
 celery_session = CelerySession()
@@ -63,7 +171,7 @@ class CeleryDataManager:
         self.session._flush()
 
     def tpc_finish(self, transaction):
-        pass
+        self.session._dispatch()
 
     def sortKey(self):
         # Sort last, so that sending to celery is done after all other
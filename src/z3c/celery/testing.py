@@ -1,4 +1,5 @@
 import ZODB
+import ZODB.DemoStorage
 import ZODB.FileStorage
 import contextlib
 import os
@@ -21,21 +22,50 @@ site-definition {ftesting_path}
 </eventlog>
 """
 
+# Variant of ZOPE_CONF_TEMPLATE for tests which need no persistence on disk,
+# `zodb_path` is ignored.
+IN_MEMORY_ZOPE_CONF_TEMPLATE = """
+site-definition {ftesting_path}
+
+<zodb>
+  <mappingstorage>
+  </mappingstorage>
+</zodb>
+
+{product_config}
+
+# eventlog is required :-(
+<eventlog>
+</eventlog>
+"""
+
 
 @contextlib.contextmanager
-def open_zodb_copy(zodb_path):
+def open_zodb_copy(zodb_path, copy=True):
     """Context manager which opens a copy of the given ZODB.
 
     This might be useful if the actual ZODB is still opened by another process.
     Yields the application object inside the ZODB.
+
+    With `copy=False` the file is not copied but opened read-only below a
+    DemoStorage, which keeps changes in memory. This is much faster for large
+    files.
     """
-    new_zodb_path = zodb_path + '.copy'
-    shutil.copy(zodb_path, new_zodb_path)
-    zodbDB = ZODB.DB(ZODB.FileStorage.FileStorage(file_name=new_zodb_path))
+    if copy:
+        new_zodb_path = zodb_path + '.copy'
+        shutil.copy(zodb_path, new_zodb_path)
+        storage = ZODB.FileStorage.FileStorage(file_name=new_zodb_path)
+    else:
+        new_zodb_path = None
+        storage = ZODB.DemoStorage.DemoStorage(
+            base=ZODB.FileStorage.FileStorage(
+                file_name=zodb_path, read_only=True))
+    zodbDB = ZODB.DB(storage)
     connection = zodbDB.open()
     try:
         yield connection.root()['Application']
     finally:
         connection.close()
         zodbDB.close()
-        os.unlink(new_zodb_path)
+        if new_zodb_path is not None:
+            os.unlink(new_zodb_path)
@@ -0,0 +1,167 @@
+"""Benchmarks for the overhead z3c.celery adds to enqueueing and running tasks.
+
+Runs without external services: the broker is kombu's in-memory transport and
+the ZODB uses a MappingStorage. Prints the results as JSON::
+
+    $ python -m z3c.celery.tests.benchmark [--repeat=3] > results.json
+
+Each result contains the benchmark `name`, the number of calls `n`, the best
+total duration `seconds` out of all repetitions and `per_call` seconds.
+"""
+from z3c.celery.celery import TransactionAwareTask
+from z3c.celery.loader import ZopeLoader
+from z3c.celery.session import celery_session
+import argparse
+import celery
+import celery.app.trace
+import celery.utils
+import json
+import persistent
+import sys
+import time
+import transaction
+import ZODB
+import zope.app.publication.zopepublication
+import zope.authentication.interfaces
+import zope.component
+import zope.component.hooks
+import zope.principalregistry.principalregistry
+import zope.security.management
+
+
+SIZES = (1, 10, 100, 1000)
+
+
+class Site(persistent.Persistent):
+
+    def getSiteManager(self):
+        return zope.component.getGlobalSiteManager()
+
+
+def create_app(**config):
+    app = celery.Celery(
+        'benchmark', task_cls=TransactionAwareTask, loader=ZopeLoader,
+        strict_typing=False, set_as_current=False)
+    app.conf.update(
+        broker_url='memory://', task_ignore_result=True, **config)
+    return app
+
+
+def setup_zope(app):
+    db = ZODB.DB(None)
+    with db.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name] = (
+                Site())
+    app.conf['ZODB'] = db
+    registry = zope.principalregistry.principalregistry.principalRegistry
+    registry.definePrincipal('zope.user', 'User', login='user')
+    zope.component.provideUtility(
+        registry, zope.authentication.interfaces.IAuthentication)
+    return db
+
+
+def purge(app):
+    with app.connection_for_write() as connection:
+        try:
+            connection.default_channel.queue_purge('celery')
+        except Exception:
+            pass
+
+
+def measure(name, n, run, repeat, results, before=None, after=None):
+    """Measure `run()`, calling `before()` and `after()` around it."""
+    best = None
+    for i in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        run()
+        duration = time.perf_counter() - start
+        if after is not None:
+            after()
+        best = duration if best is None else min(best, duration)
+    results.append(dict(name=name, n=n, seconds=best, per_call=best / n))
+
+
+def queue_tasks(task, n):
+    def queue():
+        transaction.begin()
+        for i in range(n):
+            task.delay('uniqueId-%s' % i, ['a', 'b', 'c'])
+    return queue
+
+
+def run_in_worker(task, n, principal_id):
+    """Run tasks like the worker does after receiving their messages."""
+    tracer = celery.app.trace.build_tracer(
+        task.name, task, app=task.app, eager=False, propagate=True)
+    kw = {}
+    if isinstance(task, TransactionAwareTask):
+        kw = {'_run_asynchronously_': True, '_principal_id_': principal_id}
+
+    def run():
+        for i in range(n):
+            task_id = celery.utils.gen_unique_id()
+            tracer(task_id, ('uniqueId', ['a', 'b', 'c']), dict(kw), {
+                'id': task_id, 'delivery_info': {}})
+    return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args(argv)
+    repeat = options.repeat
+    results = []
+
+    for bulk in (False, True):
+        app = create_app(BULK_PUBLISH=bulk)
+        suffix = '_bulk' if bulk else ''
+
+        @app.task(name='benchmark.task')
+        def task(unique_id, items):
+            pass
+
+        for n in SIZES:
+            # `delay()` until the task is in the session (without commit)
+            measure('delay' + suffix, n, queue_tasks(task, n), repeat,
+                    results, after=transaction.abort)
+            # Publishing all tasks of the session to the broker
+            measure('flush' + suffix, n, celery_session._flush, repeat,
+                    results, before=queue_tasks(task, n),
+                    after=lambda: (transaction.abort(), purge(app)))
+            # Committing a transaction with n tasks in the session
+            measure('commit' + suffix, n, transaction.commit, repeat,
+                    results, before=queue_tasks(task, n),
+                    after=lambda: purge(app))
+
+    app = create_app()
+    db = setup_zope(app)
+
+    @app.task(name='benchmark.transaction_aware_task')
+    def transaction_aware_task(unique_id, items):
+        pass
+
+    @app.task(name='benchmark.bare_task', base=celery.Task)
+    def bare_task(unique_id, items):
+        pass
+
+    n = max(SIZES)
+    measure('worker_bare', n, run_in_worker(bare_task, n, None), repeat,
+            results)
+    measure('worker_anonymous', n,
+            run_in_worker(transaction_aware_task, n, None), repeat, results)
+    measure('worker_principal', n,
+            run_in_worker(transaction_aware_task, n, 'zope.user'), repeat,
+            results)
+    zope.security.management.endInteraction()
+    zope.component.hooks.setSite(None)
+    db.close()
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+from ..backoff import AdaptiveBackoff, ExponentialBackoff
+from celery import shared_task
+from unittest import mock
+import ZODB.POSException
+import zope.security.management
+
+
+@shared_task(affinity='unique_id')
+def backoff_task(unique_id):
+    """Dummy task with an affinity."""
+
+
+def push_request(unique_id):
+    backoff_task.push_request(args=(unique_id,), kwargs={})
+
+
+def test_backoff__AdaptiveBackoff__1():
+    """It stretches the delays of calls whose task or affinity key recently
+    conflicted and shrinks them again after successful calls."""
+    backoff = AdaptiveBackoff(weight=0.5, min_factor=1, max_factor=3)
+    push_request('one')
+    try:
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            assert 4 == backoff.countdown(backoff_task, 2)
+            backoff.conflict(backoff_task)
+            assert 0.5 == backoff.rate(backoff_task)
+            assert 8 == backoff.countdown(backoff_task, 2)
+            backoff.success(backoff_task)
+            assert 0.25 == backoff.rate(backoff_task)
+    finally:
+        backoff_task.pop_request()
+    push_request('two')
+    try:
+        backoff.conflict(backoff_task)
+        # The rate of the task name is shared, the one of the key not.
+        assert 0.625 == backoff.rate(backoff_task)
+        assert {
+            'z3c.celery.tests.test_backoff.backoff_task',
+            ('z3c.celery.tests.test_backoff.backoff_task', 'one'),
+            ('z3c.celery.tests.test_backoff.backoff_task', 'two'),
+        } == set(backoff._rates)
+    finally:
+        backoff_task.pop_request()
+
+
+def test_backoff__AdaptiveBackoff__2():
+    """It limits the delay and the number of tracked keys."""
+    backoff = AdaptiveBackoff(max_delay=10, maxsize=2)
+    for unique_id in ['one', 'two']:
+        push_request(unique_id)
+        try:
+            backoff.conflict(backoff_task)
+        finally:
+            backoff_task.pop_request()
+    assert 2 == len(backoff._rates)
+    push_request('one')
+    try:
+        with mock.patch('random.uniform', side_effect=lambda a, b: b):
+            assert 10 == backoff.countdown(backoff_task, 10)
+    finally:
+        backoff_task.pop_request()
+
+
+@shared_task
+def conflict_task():
+    raise ZODB.POSException.ConflictError()
+
+
+def test_backoff__1(interaction, eager_celery_app):
+    """It uses the policy configured in `CONFLICT_BACKOFF` for retries after
+    ConflictErrors."""
+    eager_celery_app.conf['CONFLICT_BACKOFF'] = (
+        'z3c.celery.backoff.AdaptiveBackoff')
+    zope.security.management.endInteraction()
+    with mock.patch('z3c.celery.celery.TransactionAwareTask.configure_zope'), \
+            mock.patch.object(conflict_task, 'retry') as retry, \
+            mock.patch.object(AdaptiveBackoff, 'countdown',
+                              return_value=42) as countdown:
+        conflict_task(_run_asynchronously_=True)
+    assert isinstance(eager_celery_app.conf['CONFLICT_BACKOFF_POLICY'],
+                      AdaptiveBackoff)
+    countdown.assert_called_with(conflict_task, 0)
+    retry.assert_called_with(countdown=42)
+
+
+def test_backoff__2(eager_celery_app):
+    """It uses the fixed exponential backoff by default."""
+    assert isinstance(conflict_task._backoff(), ExponentialBackoff)
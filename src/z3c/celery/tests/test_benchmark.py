@@ -0,0 +1,25 @@
+from . import benchmark
+from unittest import mock
+from zope.principalregistry.principalregistry import principalRegistry
+import json
+import plone.testing.zca
+
+
+def test_benchmark__main__1(capsys):
+    """It prints machine-readable results of all benchmarks."""
+    plone.testing.zca.pushGlobalRegistry()
+    try:
+        with mock.patch.object(benchmark, 'SIZES', (1, 2)):
+            benchmark.main(['--repeat=1'])
+    finally:
+        plone.testing.zca.popGlobalRegistry()
+        principalRegistry._clear()
+    results = json.loads(capsys.readouterr().out)
+    assert [
+        ('delay', 1), ('flush', 1), ('commit', 1),
+        ('delay', 2), ('flush', 2), ('commit', 2),
+        ('delay_bulk', 1), ('flush_bulk', 1), ('commit_bulk', 1),
+        ('delay_bulk', 2), ('flush_bulk', 2), ('commit_bulk', 2),
+        ('worker_bare', 2), ('worker_anonymous', 2), ('worker_principal', 2),
+    ] == [(x['name'], x['n']) for x in results]
+    assert all(x['seconds'] > 0 for x in results)
@@ -5,14 +5,21 @@ from z3c.celery.celery import HandleAfterAbort, Abort
 from z3c.celery.session import celery_session
 from z3c.celery.testing import open_zodb_copy
 import ZODB.POSException
+import concurrent.futures
 import datetime
+import functools
+import json
+import time
 from unittest import mock
 import pytest
 import transaction
 import z3c.celery
 import z3c.celery.celery
+import z3c.celery.serialization
 import z3c.celery.testing
+import zope.app.publication.zopepublication
 import zope.authentication.interfaces
+import zope.component.hooks
 import zope.security.management
 
 
@@ -146,6 +153,250 @@ def test_celery__TransactionAwareTask__apply_async__5(
         '1st param', _run_asynchronously_=True, _principal_id_=u'zope.user')
 
 
+@shared_task(serializer='pickle')
+def pickled_task(value):
+    """Dummy task which is sent using pickle."""
+
+
+def test_celery__TransactionAwareTask___apply_serialized__1(eager_celery_app):
+    """It sends the JSON payload as message body without decoding it."""
+    eager_celery_app.conf['task_always_eager'] = False
+    with mock.patch('celery.Task.apply_async') as apply_async:
+        eager_task._apply_serialized('id', b'[["one"], {}]')
+    args, kw = apply_async.call_args.args
+    assert b'[["one"], {}]' == args.payload
+    options = apply_async.call_args.kwargs
+    assert z3c.celery.serialization.SERIALIZER == options['serializer']
+    assert ('["one"]', '{}') == (options['argsrepr'], options['kwargsrepr'])
+
+
+def test_celery__TransactionAwareTask___apply_serialized__2(eager_celery_app):
+    """It decodes the payload if the task uses another serializer."""
+    eager_celery_app.conf['task_always_eager'] = False
+    with mock.patch('celery.Task.apply_async') as apply_async:
+        pickled_task._apply_serialized('id', b'[["one"], {}]')
+    apply_async.assert_called_with(('one',), {}, task_id='id')
+
+
+def test_celery__TransactionAwareTask___apply_serialized__3(eager_celery_app):
+    """It decodes the payload if tasks are routed, so the routers get the
+    arguments."""
+    eager_celery_app.conf['task_always_eager'] = False
+    eager_celery_app.conf['task_routes'] = {'*': {'queue': 'other'}}
+    with mock.patch('celery.Task.apply_async') as apply_async:
+        eager_task._apply_serialized('id', b'[["one"], {}]')
+    apply_async.assert_called_with(('one',), {}, task_id='id')
+
+
+@shared_task(chunk_size=2)
+def chunked_task(value):
+    """Dummy task which is sent in chunks."""
+    if value == 'error':
+        raise RuntimeError(value)
+    return value
+
+
+def test_celery__TransactionAwareTask__apply_async__6(
+        interaction, eager_celery_app):
+    """It packs calls of tasks with `chunk_size` into chunk messages."""
+    asynch = 'z3c.celery.celery.TransactionAwareTask._eager_use_session_'
+    with mock.patch(asynch, new=True):
+        chunked_task.delay('one')
+        chunked_task.delay('two')
+        chunked_task.delay('three')
+        chunked_task.apply_async(('four',), countdown=1)
+    assert 4 == len(celery_session)
+    task_call = 'z3c.celery.celery.TransactionAwareTask.__call__'
+    with mock.patch(task_call) as task_call:
+        zope.security.management.endInteraction()
+        transaction.commit()
+    kw = {'_principal_id_': 'zope.user', '_run_asynchronously_': True}
+    assert [
+        mock.call(_chunk_=[[['one'], kw], [['two'], kw]],
+                  _run_asynchronously_=True),
+        mock.call(_chunk_=[[['three'], kw]],
+                  _run_asynchronously_=True),
+        mock.call('four', _principal_id_='zope.user',
+                  _run_asynchronously_=True),
+    ] == sorted(task_call.call_args_list, key=lambda x: bool(x.args))
+
+
+def test_celery__TransactionAwareTask__run_chunk__1(
+        interaction, eager_celery_app, zcml):
+    """It runs each item of a chunk and raises the first error at the end."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    with mock.patch(configure_zope), \
+            mock.patch.object(
+                chunked_task, 'run', wraps=chunked_task.run) as run:
+        with pytest.raises(RuntimeError):
+            chunked_task(_run_asynchronously_=True, _chunk_=[
+                [['error'], {'_principal_id_': 'zope.user'}],
+                [['one'], {'_principal_id_': 'zope.user'}]])
+    assert [mock.call('error'), mock.call('one')] == run.call_args_list
+
+
+def test_celery__TransactionAwareTask__run_chunk__2(
+        interaction, eager_celery_app, zcml):
+    """It returns the results of the chunk items."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    with mock.patch(configure_zope):
+        assert ['one', 'two'] == chunked_task(
+            _run_asynchronously_=True, _chunk_=[
+                [['one'], {'_principal_id_': 'zope.user'}],
+                [['two'], {'_principal_id_': 'zope.user'}]])
+
+
+def test_celery__TransactionAwareTask__run_chunk__6(
+        interaction, eager_celery_app, zcml):
+    """It runs each item of a chunk with a task_id of its own."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    task_ids = []
+    chunk_id = chunked_task.request.id
+    with mock.patch(configure_zope), \
+            mock.patch.object(chunked_task, 'run', side_effect=lambda value: (
+                task_ids.append(chunked_task.request.id))):
+        chunked_task(_run_asynchronously_=True, _chunk_=[
+            [['one'], {'_principal_id_': 'zope.user'}],
+            [['two'], {'_principal_id_': 'zope.user'}]])
+    assert 2 == len(set(task_ids))
+    assert chunk_id not in task_ids
+    assert chunk_id == chunked_task.request.id
+
+
+@shared_task(chunk_size=2, chunk_batch=True)
+def batched_task(value):
+    """Dummy task whose chunks run in one transaction."""
+    if value == 'error':
+        raise RuntimeError(value)
+    return value, transaction.get()
+
+
+def test_celery__TransactionAwareTask__run_chunk__3(
+        interaction, eager_celery_app, zcml):
+    """It runs the items of a principal in one transaction if `chunk_batch`
+    is set."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    with mock.patch(configure_zope):
+        (one, txn1), (two, txn2), (three, txn3) = batched_task(
+            _run_asynchronously_=True, _chunk_=[
+                [['one'], {'_principal_id_': 'zope.user'}],
+                [['two'], {'_principal_id_': 'zope.user'}],
+                [['three'], {'_principal_id_': 'example.user'}]])
+    assert ['one', 'two', 'three'] == [one, two, three]
+    assert txn1 is txn2
+    assert txn1 is not txn3
+    assert '/ zope.user' == txn1.user
+    assert '/ example.user' == txn3.user
+
+
+def test_celery__TransactionAwareTask__run_chunk__4(
+        interaction, eager_celery_app, zcml):
+    """It runs the items one by one if the batch fails, so only the failing
+    item reports its error."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    run_items = batched_task._run_items
+    item_results = []
+
+    def record_results(*args):
+        results, error = run_items(*args)
+        item_results.append((results, error))
+        return results, error
+
+    with mock.patch(configure_zope), \
+            mock.patch.object(
+                batched_task, 'run', wraps=batched_task.run) as run, \
+            mock.patch.object(
+                batched_task, '_run_items', side_effect=record_results):
+        with pytest.raises(RuntimeError):
+            batched_task(_run_asynchronously_=True, _chunk_=[
+                [['one'], {'_principal_id_': 'zope.user'}],
+                [['error'], {'_principal_id_': 'zope.user'}],
+                [['two'], {'_principal_id_': 'example.user'}]])
+    assert [mock.call('one'), mock.call('error')] * 2 + [
+        mock.call('two')] == run.call_args_list
+    [(results, error)] = item_results
+    assert 'one' == results[0][0]
+    assert results[1] is None
+    assert 'error' == str(error)
+
+
+def test_celery__TransactionAwareTask__run_chunk__5(
+        interaction, eager_celery_app, zcml):
+    """It runs the items one by one if the batch conflicts."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    with mock.patch(configure_zope), \
+            mock.patch.object(batched_task, 'run', side_effect=[
+                ZODB.POSException.ConflictError(), 'one', 'two']):
+        assert ['one', 'two'] == batched_task(
+            _run_asynchronously_=True, _chunk_=[
+                [['one'], {'_principal_id_': 'zope.user'}],
+                [['two'], {'_principal_id_': 'zope.user'}]])
+
+
+def test_celery__TransactionAwareTask__run_chunk__7(
+        interaction, eager_celery_app, zcml):
+    """It applies `prefetch` and `memoize` to each item of a batch."""
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    zope.security.management.endInteraction()
+    with mock.patch(configure_zope), \
+            mock.patch.object(batched_task, '_prefetch') as prefetch, \
+            mock.patch.object(batched_task, '_memo') as memo:
+        memo.return_value.hit = True
+        memo.return_value.result = 'memoized'
+        assert ['memoized', 'memoized'] == batched_task(
+            _run_asynchronously_=True, _chunk_=[
+                [['one'], {'_principal_id_': 'zope.user'}],
+                [['two'], {'_principal_id_': 'zope.user'}]])
+    assert [mock.call(['one'], {}), mock.call(['two'], {})] == (
+        prefetch.call_args_list)
+
+
+@shared_task(coalesce=True)
+def coalesced_task(value):
+    """Dummy task whose repeated calls are coalesced."""
+
+
+def test_celery__TransactionAwareTask__apply_async__7(interaction):
+    """It sends repeated calls of tasks with `coalesce` only once."""
+    result = coalesced_task.delay('one')
+    assert result.id == coalesced_task.delay('one').id
+    assert 1 == len(celery_session)
+    coalesced_task.delay('two')
+    coalesced_task.apply_async(('one',), countdown=1)
+    coalesced_task.apply_async(('one',), task_id='my-id')
+    assert 4 == len(celery_session)
+    zope.security.management.endInteraction()
+    coalesced_task.delay('one')
+    assert 5 == len(celery_session)
+
+
+@shared_task(coalesce=True)
+def coalesced_kw_task(a=None, b=None):
+    """Dummy task with keyword arguments whose repeated calls are coalesced.
+    """
+
+
+def test_celery__TransactionAwareTask__apply_async__11(interaction):
+    """It coalesces calls regardless of the order of keyword arguments."""
+    result = coalesced_kw_task.delay(a=1, b=2)
+    assert result.id == coalesced_kw_task.delay(b=2, a=1).id
+    assert 1 == len(celery_session)
+
+
+def test_celery__TransactionAwareTask__apply_async__8(interaction):
+    """It coalesces calls only within one transaction."""
+    coalesced_task.delay('one')
+    transaction.abort()
+    coalesced_task.delay('one')
+    assert 1 == len(celery_session)
+
+
 @shared_task
 def exception_task(context=None, datetime=None):
     """Dummy task which raises an exception to test our framework."""
@@ -258,6 +509,71 @@ def test_celery__TransactionAwareTask____call____2a(eager_celery_app):
         assert conflicts_after_abort == 2
 
 
+deferred_after_abort = []
+
+
+def conflicts_unless_deferred(value):
+    if not deferred_after_abort:
+        transaction.get().join(VoteExceptionDataManager())
+    deferred_after_abort.append(value)
+
+
+@shared_task(max_retries=2)
+def conflict_after_abort_deferred_task():
+    raise HandleAfterAbort(conflicts_unless_deferred, 'value')
+
+
+def test_celery__TransactionAwareTask____call____2c(eager_celery_app):
+    """It retries the after-abort portion in a separate task if
+    `DEFER_AFTER_ABORT_RETRY` is set."""
+    eager_celery_app.conf['DEFER_AFTER_ABORT_RETRY'] = True
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    with mock.patch(configure_zope), \
+            mock.patch('time.sleep') as sleep, \
+            mock.patch('z3c.celery.celery.run_after_abort.apply_async',
+                       side_effect=lambda args, **kw:
+                       z3c.celery.celery.run_after_abort(*args)) as deferred:
+        with pytest.raises(HandleAfterAbort):
+            conflict_after_abort_deferred_task(_run_asynchronously_=True)
+    assert not sleep.called
+    assert 'z3c.celery.tests.test_celery:conflicts_unless_deferred' == (
+        deferred.call_args.args[0][0])
+    assert 0 <= deferred.call_args.kwargs['countdown'] <= 1
+    assert ['value', 'value'] == deferred_after_abort
+
+
+def test_celery__TransactionAwareTask___defer_after_abort__1(
+        eager_celery_app):
+    """It does not defer callbacks which cannot be imported or whose
+    arguments are not JSON serializable."""
+    eager_celery_app.conf['DEFER_AFTER_ABORT_RETRY'] = True
+    task = conflict_after_abort_deferred_task
+    assert not task._defer_after_abort(
+        HandleAfterAbort(lambda: None), None, 0)
+    assert not task._defer_after_abort(
+        HandleAfterAbort(conflicts_unless_deferred, object()), None, 0)
+
+
+class CallableCallback:
+
+    def __call__(self):
+        pass
+
+
+def test_celery__TransactionAwareTask___defer_after_abort__2(
+        eager_celery_app):
+    """It does not defer callbacks without a dotted name or handles without
+    a callback."""
+    eager_celery_app.conf['DEFER_AFTER_ABORT_RETRY'] = True
+    task = conflict_after_abort_deferred_task
+    assert not task._defer_after_abort(HandleAfterAbort(
+        functools.partial(conflicts_unless_deferred, 'value')), None, 0)
+    assert not task._defer_after_abort(
+        HandleAfterAbort(CallableCallback()), None, 0)
+    assert not task._defer_after_abort(
+        z3c.celery.celery.Retry(), None, 0)
+
+
 @shared_task(max_retries=1)
 def conflict_during_task():
     raise ZODB.POSException.ConflictError()
@@ -393,6 +709,47 @@ def test_celery__TransactionAwareTask__run_in_worker__2(
         assert 'flub' not in app
 
 
+def test_celery__PrincipalCache__get__1(zcml):
+    """It caches principals for `ttl` seconds."""
+    cache = z3c.celery.celery.PrincipalCache(ttl=10)
+    with mock.patch('z3c.celery.celery.get_principal',
+                    wraps=z3c.celery.celery.get_principal) as get_principal, \
+            mock.patch('time.monotonic', return_value=100):
+        principal = cache.get('example.user')
+        assert 'Ben Utzer' == principal.title
+        assert principal is cache.get('example.user')
+        assert 1 == get_principal.call_count
+    with mock.patch('z3c.celery.celery.get_principal') as get_principal, \
+            mock.patch('time.monotonic', return_value=111):
+        assert get_principal.return_value == cache.get('example.user')
+
+
+def test_celery__PrincipalCache__get__2(zcml):
+    """It keeps at most `maxsize` principals."""
+    cache = z3c.celery.celery.PrincipalCache(ttl=10, maxsize=1)
+    cache.get('example.user')
+    cache.get('zope.user')
+    with mock.patch('z3c.celery.celery.get_principal') as get_principal:
+        cache.get('zope.user')
+        assert not get_principal.called
+        cache.get('example.user')
+        assert get_principal.called
+
+
+def test_celery__TransactionAwareTask__transaction__1(
+        eager_celery_app, zcml):
+    """It uses a principal cache if `PRINCIPAL_CACHE_TTL` is set."""
+    eager_celery_app.conf['PRINCIPAL_CACHE_TTL'] = 60
+    configure_zope = 'z3c.celery.celery.TransactionAwareTask.configure_zope'
+    with mock.patch(configure_zope), \
+            mock.patch('z3c.celery.celery.get_principal',
+                       wraps=z3c.celery.celery.get_principal) as get_principal:
+        for i in range(2):
+            assert 'Ben Utzer' == get_principal_title_task(
+                _run_asynchronously_=True, _principal_id_='example.user')
+    assert 1 == get_principal.call_count
+
+
 def test_celery__HandleAfterAbort__1():
     """It returns the message in the exception unicode which was passed in."""
     err = HandleAfterAbort(lambda: None, message=u'test-messäge')
@@ -462,3 +819,166 @@ def test_celery__TransactionAwareTask_retry(
     result = get_principal_retry.delay()
     transaction.commit()
     assert [1, 'User'] == result.get()
+
+
+def test_celery__TransactionAwareTask__configure_zope__1(zodb):
+    """It opens a new ZODB connection for each task and sets the site."""
+    with eager_task.configure_zope():
+        site = zope.component.hooks.getSite()
+        connection = site._p_jar
+        assert connection.opened is not None
+    assert connection.opened is None
+    assert zope.component.hooks.getSite() is None
+
+
+def test_celery__TransactionAwareTask__configure_zope__2(zodb):
+    """It keeps the connection open across tasks if
+    `REUSE_ZODB_CONNECTION` is set, but sees changes of other connections."""
+    eager_task.app.conf['REUSE_ZODB_CONNECTION'] = True
+    with eager_task.configure_zope():
+        site = zope.component.hooks.getSite()
+        assert not hasattr(site, 'changed')
+    assert zope.component.hooks.getSite() is None
+
+    with zodb.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name
+        ].changed = True
+
+    with eager_task.configure_zope():
+        assert site is zope.component.hooks.getSite()
+        assert site._p_jar.opened is not None
+        assert site.changed
+
+
+@z3c.celery.task(read_only=True)
+def read_only_task(modify=False, queue=False, conflict=False):
+    site = zope.component.hooks.getSite()
+    if modify:
+        site.changed = True
+    if queue:
+        eager_task.delay()
+    if conflict:
+        raise ZODB.POSException.ConflictError()
+    return transaction.get().user
+
+
+def test_celery__TransactionAwareTask__read_only__1(
+        eager_celery_app, zodb, zcml):
+    """It does not commit the transaction of a `read_only` task."""
+    with mock.patch('transaction.commit') as commit:
+        assert '' == read_only_task(
+            _run_asynchronously_=True, _principal_id_='zope.user')
+    assert not commit.called
+
+
+def test_celery__TransactionAwareTask__read_only__2(eager_celery_app, zodb):
+    """It raises a ReadOnlyError if a `read_only` task modifies data."""
+    with pytest.raises(z3c.celery.celery.ReadOnlyError):
+        read_only_task(modify=True, _run_asynchronously_=True)
+    with zodb.transaction() as connection:
+        assert not hasattr(connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name],
+            'changed')
+
+
+def test_celery__TransactionAwareTask__read_only__3(eager_celery_app, zodb):
+    """It sends the tasks queued by a `read_only` task."""
+    asynch = 'z3c.celery.celery.TransactionAwareTask._eager_use_session_'
+    with mock.patch(asynch, new=True), \
+            mock.patch.object(eager_task, '_apply_serialized') as apply:
+        read_only_task(queue=True, _run_asynchronously_=True)
+    assert apply.called
+
+
+def test_celery__TransactionAwareTask__read_only__4(eager_celery_app, zodb):
+    """It does not retry a `read_only` task on ConflictError."""
+    with mock.patch.object(read_only_task, 'retry') as retry, \
+            pytest.raises(ZODB.POSException.ConflictError):
+        read_only_task(conflict=True, _run_asynchronously_=True)
+    assert not retry.called
+
+
+def test_celery___conf_singleton__1():
+    """It creates the object only once if several threads need it."""
+    conf = {}
+    created = []
+
+    def factory():
+        time.sleep(0.01)
+        created.append(object())
+        return created[-1]
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        values = list(executor.map(
+            lambda _: z3c.celery.celery._conf_singleton(
+                conf, 'KEY', factory), range(8)))
+    assert 1 == len(created)
+    assert [created[0]] * 8 == values
+
+
+@shared_task(affinity='unique_id')
+def affinity_task(unique_id):
+    """Dummy task which is routed by its argument."""
+
+
+def test_celery__TransactionAwareTask__apply_async__9(
+        interaction, eager_celery_app):
+    """It sends calls with the same affinity key to the same partition
+    queue if `AFFINITY_QUEUES` is set."""
+    eager_celery_app.conf['task_always_eager'] = False
+    eager_celery_app.conf['AFFINITY_QUEUES'] = 4
+    queues = z3c.celery.celery.affinity_queues(eager_celery_app)
+    assert 'z3c.celery.affinity.3' == queues[-1]
+    with mock.patch.object(celery_session, 'add_call') as add_call:
+        for unique_id in ['one', 'two', 'one']:
+            affinity_task.delay(unique_id)
+        affinity_task.apply_async(kw={'unique_id': 'one'}, queue='other')
+    one, two, one_again, other = [
+        call.kwargs['queue'] for call in add_call.call_args_list]
+    assert 'one' == json.loads(
+        add_call.call_args.args[2])[1]['unique_id']
+    assert one == one_again
+    assert one in queues
+    assert two in queues
+    assert 'other' == other
+
+
+def test_celery__TransactionAwareTask__apply_async__10(interaction):
+    """It does not partition calls without `AFFINITY_QUEUES`."""
+    with mock.patch.object(celery_session, 'add_call') as add_call:
+        affinity_task.delay('one')
+    assert 'queue' not in add_call.call_args.kwargs
+
+
+@z3c.celery.task
+def thread_state_task(value):
+    site = zope.component.hooks.getSite()
+    interaction = zope.security.management.getInteraction()
+    # Give the other threads a chance to run at the same time.
+    time.sleep(0.01)
+    assert site is zope.component.hooks.getSite()
+    assert interaction is zope.security.management.getInteraction()
+    return (value, site._p_jar,
+            interaction.participations[0].principal.id, transaction.get())
+
+
+@pytest.mark.parametrize('reuse', [False, True])
+def test_celery__TransactionAwareTask__threads__1(
+        eager_celery_app, zcml, zodb, reuse):
+    """It keeps the Zope state of tasks which run in several threads of the
+    same process apart."""
+    eager_celery_app.conf['REUSE_ZODB_CONNECTION'] = reuse
+    principals = ['zope.user', 'example.user'] * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda x: thread_state_task(
+                x[0], _run_asynchronously_=True, _principal_id_=x[1]),
+            enumerate(principals)))
+    assert list(range(8)) == [x[0] for x in results]
+    assert principals == [x[2] for x in results]
+    assert 8 == len({id(x[3]) for x in results})
+    if reuse:
+        # One connection per thread.
+        assert len({id(x[1]) for x in results}) <= 4
+    assert zope.component.hooks.getSite() is None
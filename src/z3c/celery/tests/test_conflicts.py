@@ -0,0 +1,68 @@
+from ..conflicts import Hotspots, load, main
+from celery import shared_task
+from unittest import mock
+import os
+import persistent
+import pytest
+import ZODB.POSException
+import zope.security.management
+
+
+class Folder(persistent.Persistent):
+    pass
+
+
+@shared_task
+def conflicting_task(stage):
+    if stage == 'run':
+        raise ZODB.POSException.ConflictError(
+            oid=b'\0\0\0\0\0\0\0\x2a', object=Folder())
+
+
+@pytest.fixture(scope='function')
+def hotspots():
+    hotspots = Hotspots()
+    hotspots.connect()
+    yield hotspots
+    hotspots.disconnect()
+
+
+def test_conflicts__Hotspots__1(hotspots, interaction, eager_celery_app):
+    """It records the conflicts of tasks run in the worker."""
+    zope.security.management.endInteraction()
+    with mock.patch.object(conflicting_task, 'retry'), \
+            mock.patch('z3c.celery.celery.TransactionAwareTask.'
+                       'configure_zope'):
+        for i in range(2):
+            conflicting_task('run', _run_asynchronously_=True)
+        with mock.patch('transaction.commit',
+                        side_effect=ZODB.POSException.ConflictError()):
+            conflicting_task('commit', _run_asynchronously_=True)
+    assert [{
+        'task_name': conflicting_task.name, 'oid': '0x2a',
+        'class_name': 'z3c.celery.tests.test_conflicts.Folder',
+        'stage': 'run', 'count': 2, 'max_retries': 0,
+    }, {
+        'task_name': conflicting_task.name, 'oid': None, 'class_name': None,
+        'stage': 'commit', 'count': 1, 'max_retries': 0,
+    }] == hotspots.report()
+
+
+def test_conflicts__load__1(hotspots, tmp_path, capsys):
+    """It aggregates the hotspots dumped by several processes."""
+    hotspots(None, task_name='task', stage='run', oid='0x2a',
+             class_name='Folder', retries=1)
+    hotspots.dump(str(tmp_path))
+    # Pretend the first dump was made by another process.
+    os.rename(tmp_path / 'conflicts-{}.json'.format(os.getpid()),
+              tmp_path / 'conflicts-1.json')
+    hotspots(None, task_name='task', stage='run', oid='0x2a',
+             class_name='Folder', retries=3)
+    hotspots.dump(str(tmp_path))
+    assert [{
+        'task_name': 'task', 'oid': '0x2a', 'class_name': 'Folder',
+        'stage': 'run', 'count': 3, 'max_retries': 3,
+    }] == load(str(tmp_path))
+    main([str(tmp_path)])
+    assert '       3       3 run    0x2a               Folder task\n' == (
+        capsys.readouterr().out.splitlines(True)[1])
@@ -0,0 +1,146 @@
+from ..dispatcher import Dispatcher, get_dispatcher, stop_dispatcher
+from ..dispatcher import _stop_dispatchers
+from ..session import celery_session
+from unittest import mock
+import celery
+import json
+import threading
+import transaction
+import z3c.celery
+
+
+@z3c.celery.task
+def dispatched_task(param=None):
+    """Dummy task to be used together with `eager_celery_app`."""
+
+
+def test_dispatcher__1(interaction, eager_celery_app):
+    """It publishes the tasks of a transaction in the dispatcher thread after
+    the transaction is finished."""
+    eager_celery_app.conf['task_always_eager'] = False
+    eager_celery_app.conf['BACKGROUND_DISPATCH'] = True
+    with mock.patch.object(celery.Task, 'apply_async', autospec=True) as \
+            apply_async, \
+            mock.patch.object(eager_celery_app, 'producer_or_acquire') as \
+            acquire:
+        dispatched_task.delay('one')
+        dispatched_task.delay('two')
+        transaction.commit()
+        assert 0 == len(celery_session.dispatched)
+        dispatcher = get_dispatcher(eager_celery_app)
+        stop_dispatcher(eager_celery_app)
+    assert not dispatcher.is_alive()
+    assert 1 == acquire.call_count
+    producer = acquire.return_value.__enter__.return_value
+    assert [['one'], ['two']] == [
+        json.loads(call.args[1].payload)[0]
+        for call in apply_async.call_args_list]
+    for call in apply_async.call_args_list:
+        assert producer is call.kwargs['producer']
+
+
+def test_dispatcher__2(interaction, eager_celery_app):
+    """It does not hand over the tasks of an aborted transaction."""
+    eager_celery_app.conf['task_always_eager'] = False
+    eager_celery_app.conf['BACKGROUND_DISPATCH'] = True
+    with mock.patch('z3c.celery.dispatcher.get_dispatcher') as get_dispatcher:
+        dispatched_task.delay('one')
+        transaction.abort()
+    assert not get_dispatcher.called
+    assert 0 == len(celery_session)
+
+
+def test_dispatcher__Dispatcher__1():
+    """It retries to acquire the producer without losing the calls."""
+    app = mock.MagicMock()
+    producer = app.producer_or_acquire.return_value.__enter__.return_value
+    connected = threading.Event()
+    results = [ConnectionError(), app.producer_or_acquire.return_value]
+
+    def acquire():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        connected.set()
+        return result
+
+    app.producer_or_acquire.side_effect = acquire
+    method = mock.Mock()
+    dispatcher = Dispatcher(app)
+    dispatcher.retry_interval = 0.01
+    dispatcher.submit([(method, ('one',), {})])
+    dispatcher.start()
+    assert connected.wait(timeout=10)
+    dispatcher.stop()
+    method.assert_called_once_with('one', producer=producer)
+
+
+def test_dispatcher__Dispatcher__2(caplog):
+    """It gives up retrying when it is stopped without a broker connection."""
+    app = mock.MagicMock()
+    failed = threading.Event()
+
+    def acquire():
+        failed.set()
+        raise ConnectionError()
+
+    app.producer_or_acquire.side_effect = acquire
+    method = mock.Mock()
+    dispatcher = Dispatcher(app)
+    dispatcher.retry_interval = 10
+    dispatcher.submit([(method, ('one',), {})])
+    dispatcher.start()
+    assert failed.wait(timeout=10)
+    dispatcher.stop()
+    assert not method.called
+    assert ('Stopped without a broker connection, 1 transactions were not '
+            'published.') in caplog.text
+
+
+def test_dispatcher__Dispatcher__3(caplog):
+    """It logs calls which fail to publish and publishes the others."""
+    app = mock.MagicMock()
+    failing = mock.Mock(side_effect=RuntimeError())
+    failing.__self__ = mock.Mock()
+    failing.__self__.name = 'failing_task'
+    method = mock.Mock()
+    dispatcher = Dispatcher(app)
+    dispatcher.submit([(failing, (), {}), (method, ('one',), {})])
+    dispatcher.start()
+    dispatcher.stop()
+    assert 'Publishing failing_task failed' in caplog.text
+    producer = app.producer_or_acquire.return_value.__enter__.return_value
+    method.assert_called_once_with('one', producer=producer)
+
+
+def test_dispatcher__get_dispatcher__1(eager_celery_app):
+    """It hands the waiting calls of a dead dispatcher to the new one."""
+    dead = Dispatcher(eager_celery_app)
+    dead.submit(['call'])
+    eager_celery_app.conf['DISPATCHER'] = dead
+    with mock.patch.object(Dispatcher, 'start'):
+        dispatcher = get_dispatcher(eager_celery_app)
+        assert dispatcher is not dead
+        assert dead.queue is dispatcher.queue
+        # After a fork the parent process publishes its calls itself:
+        eager_celery_app.conf['DISPATCHER'] = dead
+        dead.pid = -1
+        dispatcher = get_dispatcher(eager_celery_app)
+        assert dead.queue is not dispatcher.queue
+    eager_celery_app.conf['DISPATCHER'] = None
+
+
+def test_dispatcher__stop_dispatcher__1(eager_celery_app):
+    """It stops the running dispatchers of all apps at exit and does nothing
+    for apps without a dispatcher."""
+    eager_celery_app.conf['DISPATCHER'] = None
+    with mock.patch.object(eager_celery_app, 'producer_or_acquire'):
+        dispatcher = get_dispatcher(eager_celery_app)
+        _stop_dispatchers()
+    assert not dispatcher.is_alive()
+    assert eager_celery_app.conf['DISPATCHER'] is None
+    stop_dispatcher(eager_celery_app)
+    # A dispatcher whose thread is not running is only removed:
+    eager_celery_app.conf['DISPATCHER'] = Dispatcher(eager_celery_app)
+    stop_dispatcher(eager_celery_app)
+    assert eager_celery_app.conf['DISPATCHER'] is None
@@ -5,8 +5,10 @@ import plone.testing.zca
 import tempfile
 import transaction
 import unittest
+import unittest.mock
 import z3c.celery.celery
 import z3c.celery.conftest
+import z3c.celery.layer
 import z3c.celery.testing
 import zope.authentication.interfaces
 import zope.component
@@ -66,3 +68,135 @@ class EndToEndLayerTests(unittest.TestCase):
         transaction.commit()
 
         assert 'Ben Utzer' == result.get(timeout=10)
+
+
+class ThreadsSettingsLayer(plone.testing.Layer):
+    """Settings for an EndToEndLayer whose worker uses the threads pool."""
+
+    defaultBases = (SETTINGS_LAYER,)
+
+    def setUp(self):
+        self['celery_worker_parameters'] = {
+            'queues': ('hiprio', 'celery'), 'pool': 'threads',
+            'concurrency': 2}
+
+    def tearDown(self):
+        del self['celery_worker_parameters']
+
+
+THREADS_SETTINGS_LAYER = ThreadsSettingsLayer()
+THREADS_END_TO_END_LAYER = EndToEndLayer(
+    bases=[THREADS_SETTINGS_LAYER], name="ThreadsEndToEndLayer")
+ZOPE_THREADS_END_TO_END_LAYER = plone.testing.Layer(
+    bases=(THREADS_END_TO_END_LAYER, ZCML_LAYER),
+    name="ZopeThreadsEndToEndLayer")
+
+
+class ThreadsEndToEndLayerTests(unittest.TestCase):
+    """Testing ..layer.EndToEndLayer with the threads pool."""
+
+    layer = ZOPE_THREADS_END_TO_END_LAYER
+
+    def test_layer__EndToEndLayer__2(self):
+        auth = zope.component.getUtility(
+            zope.authentication.interfaces.IAuthentication)
+        principal = auth.getPrincipal('example.user')
+        z3c.celery.celery.login_principal(principal)
+        results = [get_principal_title_task.apply_async(queue='hiprio')
+                   for i in range(4)]
+
+        transaction.commit()
+
+        assert ['Ben Utzer'] * 4 == [
+            result.get(timeout=10) for result in results]
+
+
+class EndToEndLayerOptionsTests(unittest.TestCase):
+    """Testing the options of ..layer.EndToEndLayer without a broker."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = unittest.mock.patch('z3c.celery.layer.start_worker')
+        self.start_worker = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(z3c.celery.layer._stop_reusable_worker)
+
+    def make_layer(self, **resources):
+        layer = EndToEndLayer(name='OptionsEndToEndLayer')
+        layer['celery_config'] = {'broker_url': 'memory://'}
+        layer['celery_parameters'] = {}
+        layer['celery_worker_parameters'] = {}
+        layer['celery_includes'] = []
+        for name, value in resources.items():
+            layer[name] = value
+        return layer
+
+    def test_layer__EndToEndLayer__setUp__1(self):
+        """It starts a prefork worker by default and stops it on tearDown."""
+        layer = self.make_layer()
+        layer.setUp()
+        layer.tearDown()
+        assert 'prefork' == self.start_worker.call_args[1]['pool']
+        worker = self.start_worker.return_value
+        worker.__exit__.assert_called_once_with(None, None, None)
+
+    def test_layer__EndToEndLayer__setUp__2(self):
+        """It allows to choose the pool and concurrency of the worker."""
+        layer = self.make_layer(celery_worker_parameters={
+            'pool': 'threads', 'concurrency': 4})
+        layer.setUp()
+        layer.tearDown()
+        kw = self.start_worker.call_args[1]
+        assert ('threads', 4) == (kw['pool'], kw['concurrency'])
+
+    def test_layer__EndToEndLayer__setUp__3(self):
+        """It reuses a worker for the same resources if requested."""
+        layer = self.make_layer(celery_worker_reuse=True)
+        layer.setUp()
+        app = layer['celery_app']
+        layer.tearDown()
+        worker = self.start_worker.return_value
+        worker.__exit__.assert_not_called()
+        layer.setUp()
+        assert app is layer['celery_app']
+        layer.tearDown()
+        assert 1 == self.start_worker.call_count
+        worker.__exit__.assert_not_called()
+        # Other resources need a new worker:
+        layer = self.make_layer(celery_worker_reuse=True, celery_config={
+            'broker_url': 'memory://', 'task_default_queue': 'other'})
+        layer.setUp()
+        layer.tearDown()
+        worker.__exit__.assert_called_once_with(None, None, None)
+        assert 2 == self.start_worker.call_count
+
+    def test_layer__EndToEndLayer__setUp__4(self):
+        """It prefixes the broker keys with the name of the xdist worker."""
+        layer = self.make_layer(celery_config={
+            'broker_url': 'redis://localhost:6379/12'})
+        with unittest.mock.patch.dict(
+                'os.environ', {'PYTEST_XDIST_WORKER': 'gw1'}):
+            layer.setUp()
+        app = layer['celery_app']
+        layer.tearDown()
+        assert 'gw1:' == app.conf.broker_transport_options['global_keyprefix']
+
+    def test_layer__EndToEndLayer__setUp__5(self):
+        """It does not isolate the broker if `celery_xdist_isolation` is off.
+        """
+        layer = self.make_layer(celery_xdist_isolation=False)
+        with unittest.mock.patch.dict(
+                'os.environ', {'PYTEST_XDIST_WORKER': 'gw1'}):
+            layer.setUp()
+        app = layer['celery_app']
+        layer.tearDown()
+        assert {} == app.conf.broker_transport_options
+
+    def test_layer__EndToEndLayer__setUp__6(self):
+        """It refuses to isolate a broker which does not support it."""
+        layer = self.make_layer()
+        with unittest.mock.patch.dict(
+                'os.environ', {'PYTEST_XDIST_WORKER': 'gw1'}):
+            with self.assertRaises(ValueError):
+                layer.setUp()
+        self.start_worker.assert_not_called()
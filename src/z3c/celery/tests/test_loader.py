@@ -2,13 +2,19 @@ from ..loader import ZopeLoader
 from .shared_tasks import get_principal_title_task
 from unittest import mock
 from zope.principalregistry.principalregistry import principalRegistry
+import billiard.pool
 import celery.signals
 import contextlib
 import logging
 import plone.testing.zca
 import pytest
+import sys
 import tempfile
 import z3c.celery
+import z3c.celery.conftest
+import z3c.celery.loader
+import z3c.celery.logging
+import z3c.celery.timing
 import zope.app.appsetup.appsetup
 import zope.security.management
 
@@ -127,3 +133,167 @@ def test_loader__ZopeLoader__2__cov(eager_celery_app):
     with zope_loader(eager_celery_app):
         assert "Ben Utzer" == get_principal_title_task(
             _run_asynchronously_=True, _principal_id_='example.user')
+
+
+def test_loader__ZopeLoader__3__cov(eager_celery_app):
+    """It executes the ZCML in the parent process if `PRELOAD_ZOPE` is set
+    and only opens the database in the worker process.
+
+    As it is hard to collect coverage for sub-processes we use this test for
+    coverage only.
+    """
+    eager_celery_app.conf['PRELOAD_ZOPE'] = True
+    loader = eager_celery_app.loader
+    plone.testing.zca.pushGlobalRegistry()
+    try:
+        loader.on_worker_init()
+        assert ('Ben Utzer' ==
+                principalRegistry.getPrincipal('example.user').title)
+        assert 'ZODB' not in eager_celery_app.conf
+        with mock.patch('zope.app.wsgi.config') as config:
+            with zope_loader(eager_celery_app):
+                assert "Ben Utzer" == get_principal_title_task(
+                    _run_asynchronously_=True, _principal_id_='example.user')
+        assert not config.called
+    finally:
+        loader.zope_options = None
+        plone.testing.zca.popGlobalRegistry()
+
+
+def test_loader__ZopeLoader___memory_usage__1(eager_celery_app, zodb):
+    """It minimizes the ZODB caches if the process uses too much memory and
+    makes the pool recycle the process if that does not help."""
+    conf = eager_celery_app.conf
+    conf['worker_max_memory_per_child'] = 1000
+    loader = ZopeLoader(app=eager_celery_app)
+    with mock.patch('z3c.celery.loader._current_rss',
+                    side_effect=[500, 2000, 800, 2000, 1500]), \
+            mock.patch.object(zodb, 'cacheMinimize') as cacheMinimize:
+        assert 500 == loader._memory_usage()
+        assert not cacheMinimize.called
+        assert 800 == loader._memory_usage()
+        assert 1 == cacheMinimize.call_count
+        assert 1500 == loader._memory_usage()
+    conf['worker_max_memory_per_child'] = None
+    conf['MAX_CACHE_SIZE_PER_CHILD'] = 1
+    with zodb.transaction() as connection:
+        connection.root()['one'] = z3c.celery.conftest.Site()
+        connection.root()['two'] = z3c.celery.conftest.Site()
+    with mock.patch('z3c.celery.loader._current_rss', return_value=500), \
+            mock.patch.object(zodb, 'cacheMinimize'):
+        assert sys.maxsize == loader._memory_usage()
+    with mock.patch('z3c.celery.loader._current_rss', return_value=500):
+        assert 500 == loader._memory_usage()
+    assert 0 == zodb.cacheSize()
+
+
+def test_loader___current_rss__1():
+    """It returns the current resident set size of the process in KiB."""
+    rss = z3c.celery.loader._current_rss()
+    assert isinstance(rss, int)
+    assert rss > 0
+
+
+def test_loader___current_rss__2():
+    """It falls back to the peak resident set size without `/proc`."""
+    with mock.patch('builtins.open', side_effect=OSError()), \
+            mock.patch('z3c.celery.loader._peak_rss', return_value=42):
+        assert 42 == z3c.celery.loader._current_rss()
+
+
+def test_loader__ZopeLoader__on_worker_process_init__2(eager_celery_app):
+    """It replaces the memory measurement of the prefork pool if
+    `MINIMIZE_CACHE_BEFORE_RECYCLE` is set."""
+    eager_celery_app.conf['MINIMIZE_CACHE_BEFORE_RECYCLE'] = True
+    loader = eager_celery_app.loader
+    with mock.patch('billiard.pool.mem_rss'), \
+            mock.patch('zope.app.wsgi.config'):
+        loader.on_worker_process_init()
+        assert loader._memory_usage == billiard.pool.mem_rss
+
+
+def test_loader__ZopeLoader__on_worker_process_init__3(
+        eager_celery_app, caplog):
+    """It logs the task phase histograms of each worker process when it
+    shuts down if `TASK_PHASE_HISTOGRAMS` is set."""
+    eager_celery_app.conf['TASK_PHASE_HISTOGRAMS'] = True
+    loader = eager_celery_app.loader
+    histograms = z3c.celery.timing.histograms
+    with mock.patch('zope.app.wsgi.config'), \
+            mock.patch.object(
+                celery.signals.worker_process_shutdown, 'receivers', []):
+        loader.on_worker_process_init()
+        try:
+            histograms(None, phase='run', duration=0.5, task_name='task')
+            with caplog.at_level(logging.INFO):
+                celery.signals.worker_process_shutdown.send(sender=None)
+        finally:
+            histograms.disconnect()
+            histograms.reset()
+    assert "Task phase histograms: {'task': {'run':" in caplog.text
+    caplog.clear()
+    # The parent process of forked worker processes has nothing to report:
+    loader.on_worker_shutdown()
+    assert 'Task phase histograms' not in caplog.text
+
+
+def test_loader__ZopeLoader___accept_serializer__1(eager_celery_app):
+    """It accepts the messages of the `z3c.celery.json` serializer if the
+    worker accepts JSON."""
+    loader = eager_celery_app.loader
+    eager_celery_app.conf['accept_content'] = ['json']
+    loader._accept_serializer()
+    loader._accept_serializer()
+    assert ['json', 'z3c.celery.json'] == (
+        eager_celery_app.conf['accept_content'])
+    eager_celery_app.conf['accept_content'] = ['pickle']
+    loader._accept_serializer()
+    assert ['pickle'] == eager_celery_app.conf['accept_content']
+
+
+@pytest.mark.parametrize('pool', ['threads', 'solo'])
+def test_loader__ZopeLoader___set_up_unforked_pool__1(eager_celery_app, pool):
+    """It sets up Zope in the worker process if its pool does not fork."""
+    loader = eager_celery_app.loader
+    worker = mock.Mock(app=eager_celery_app, pool_cls=pool, concurrency=10)
+    with mock.patch('zope.app.wsgi.config') as config:
+        db = config.return_value
+        db.getPoolSize.return_value = 7
+        loader._set_up_unforked_pool(worker)
+    assert db is eager_celery_app.conf['ZODB']
+    db.setPoolSize.assert_called_with(10)
+
+
+def test_loader__ZopeLoader___set_up_unforked_pool__2(eager_celery_app):
+    """It leaves the setup to the worker processes of the prefork pool."""
+    loader = eager_celery_app.loader
+    worker = mock.Mock(app=eager_celery_app, pool_cls='prefork')
+    with mock.patch('zope.app.wsgi.config') as config:
+        loader._set_up_unforked_pool(worker)
+    assert not config.called
+    assert 'ZODB' not in eager_celery_app.conf
+
+
+def test_loader__ZopeLoader__on_worker_shutdown__1(eager_celery_app):
+    """It queues the log records if `QUEUED_LOGGING` is set and writes them
+    on shutdown."""
+    root = logging.getLogger()
+    queued_logging = z3c.celery.logging.queued_logging
+    with tempfile.NamedTemporaryFile() as logging_ini, \
+            tempfile.NamedTemporaryFile() as logfile, \
+            mock.patch.object(root, 'handlers', list(root.handlers)):
+        logging_ini.write(
+            LOGGING_TEMPLATE.format(filename=logfile.name).encode('utf-8'))
+        logging_ini.flush()
+        eager_celery_app.conf['LOGGING_INI'] = logging_ini.name
+        eager_celery_app.conf['QUEUED_LOGGING'] = True
+        loader = ZopeLoader(app=eager_celery_app)
+        loader.on_worker_init()
+        celery.signals.setup_logging.send(sender=None)
+        try:
+            assert queued_logging.started
+            logging.getLogger(__name__).warning('Queued Log!')
+        finally:
+            loader.on_worker_shutdown()
+        assert not queued_logging.started
+        assert 'Queued Log!' in logfile.read().decode('utf-8')
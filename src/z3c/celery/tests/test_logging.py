@@ -1,10 +1,15 @@
-from ..logging import TaskFormatter
+from ..logging import TaskFormatter, TaskContextFilter, task_context
 from .shared_tasks import shared_logging_task
+from unittest import mock
+import celery
+import json
 import logging
 import pytest
 import tempfile
+import threading
 import transaction
 import uuid
+import z3c.celery.logging
 
 
 @pytest.fixture(scope='function')
@@ -50,3 +55,157 @@ def test_logging__TaskFormatter__format__2(celery_session_worker):
                 'we are logging'.format(task_id) in log_result)
         assert "__traceback_info__: we can handle traceback info" in log_result
         assert "NotImplementedError" in log_result
+
+
+@pytest.fixture(scope='function')
+def plain_celery_app():
+    """Return a celery app running plain tasks eagerly."""
+    app = celery.Celery('test', set_as_current=False)
+    app.conf.task_always_eager = True
+    return app
+
+
+def test_logging__TaskFormatter__format__3(
+        logger_and_stream, plain_celery_app):
+    """It uses the task context which is set by the task signals."""
+    log, logged = logger_and_stream
+
+    @plain_celery_app.task(base=celery.Task, name='test.inner')
+    def inner():
+        log.info('inner')
+
+    @plain_celery_app.task(base=celery.Task, name='test.outer')
+    def outer():
+        inner.apply(task_id='inner-id')
+        log.info('outer')
+
+    outer.apply(task_id='outer-id')
+    log.info('none')
+
+    assert [
+        'task_id: inner-id name: test.inner inner',
+        'task_id: outer-id name: test.outer outer',
+        'task_id:  name:  none',
+    ] == logged.getvalue().splitlines()
+    assert ('', '') == task_context()
+
+
+@z3c.celery.task(name='test.eager')
+def eager_logging_task():
+    """Dummy task which logs using the logger of `logger_and_stream`."""
+    logging.getLogger(__name__).info('inside')
+
+
+def test_logging__TaskFormatter__format__4(
+        logger_and_stream, eager_celery_app):
+    """It provides the task name of eager and inline calls."""
+    log, logged = logger_and_stream
+    eager_logging_task.delay()
+    eager_logging_task()
+    assert ['task_id: None name: test.eager inside'] * 2 == (
+        logged.getvalue().splitlines())
+
+
+def test_logging__TaskContextFilter__filter__1(plain_celery_app):
+    """It stamps the task context on the record when it is created."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(TaskContextFilter())
+    log = logging.getLogger(__name__ + '.filter')
+    log.addHandler(handler)
+
+    @plain_celery_app.task(base=celery.Task, name='test.task')
+    def task():
+        log.warning('in task')
+
+    try:
+        task.apply(task_id='task-id')
+    finally:
+        log.removeHandler(handler)
+    assert ('task-id', 'test.task') == (
+        records[0].task_id, records[0].task_name)
+    # Formatters keep the stamped values outside of the task:
+    formatter = TaskFormatter('%(task_id)s %(message)s')
+    assert 'task-id in task' == formatter.format(records[0])
+
+
+def test_logging__FastJsonFormatter__format__1():
+    """It renders the log record as JSON including the task context."""
+    pytest.importorskip('pythonjsonlogger')
+    formatter = z3c.celery.logging.FastJsonFormatter(
+        '%(task_id)s %(message)s')
+    record = logging.LogRecord(
+        __name__, logging.INFO, __file__, 1, 'hello', (), None)
+    assert {'task_id': '', 'message': 'hello'} == json.loads(
+        formatter.format(record))
+
+
+def test_logging___orjson_dumps__1():
+    """It serializes like `json.dumps` and stringifies unknown objects."""
+    pytest.importorskip('orjson')
+    data = {'message': 'hello', 1: object}
+    assert {'message': 'hello', '1': str(object)} == json.loads(
+        z3c.celery.logging._orjson_dumps(data, indent=None, cls=None))
+
+
+def test_logging__QueuedLogging__1():
+    """It writes the log records in a listener thread until it is stopped.
+
+    After a fork the records are written by new listener threads.
+    """
+    records = []
+    handler = logging.Handler()
+    handler.emit = lambda record: records.append(
+        (record.getMessage(), threading.current_thread().name))
+    log = logging.getLogger(__name__ + '.queued')
+    log.addHandler(handler)
+    queued = z3c.celery.logging.QueuedLogging()
+    with mock.patch('z3c.celery.logging._configured_loggers',
+                    return_value=[log]):
+        queued.start()
+    try:
+        assert queued.started
+        assert handler not in log.handlers
+        log.warning('before %s', 'fork')
+        parent_listener = queued._queued[0][3]
+        queued._after_fork()
+        # Only the parent process still has the thread of this listener:
+        parent_listener.stop()
+        log.warning('after fork')
+    finally:
+        queued.stop()
+        log.removeHandler(handler)
+    assert not queued.started
+    assert ['after fork', 'before fork'] == sorted(
+        message for message, thread in records)
+    assert threading.current_thread().name not in [
+        thread for message, thread in records]
+
+
+def test_logging__QueuedLogging__2(plain_celery_app):
+    """It keeps the task context of the records for handlers which use the
+    TaskContextFilter."""
+    records = []
+    handler = logging.Handler()
+    handler.addFilter(TaskContextFilter())
+    handler.setFormatter(logging.Formatter(
+        '%(task_id)s|%(task_name)s|%(message)s'))
+    handler.emit = lambda record: records.append(handler.format(record))
+    log = logging.getLogger(__name__ + '.queued_filter')
+    log.addHandler(handler)
+    queued = z3c.celery.logging.QueuedLogging()
+    with mock.patch('z3c.celery.logging._configured_loggers',
+                    return_value=[log]):
+        queued.start()
+
+    @plain_celery_app.task(base=celery.Task, name='test.task')
+    def task():
+        log.warning('hello')
+
+    try:
+        task.apply(task_id='task-id')
+    finally:
+        queued.stop()
+        log.removeHandler(handler)
+    assert ['task-id|test.task|hello'] == records
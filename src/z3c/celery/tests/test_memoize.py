@@ -0,0 +1,114 @@
+from ..memoize import LRUCache, ResultBackendCache
+from celery import shared_task
+from unittest import mock
+import celery.backends.base
+import persistent.mapping
+import pytest
+import transaction
+import zope.app.publication.zopepublication
+import zope.component.hooks
+import zope.security.management
+
+
+runs = []
+
+
+def dependencies(task, name):
+    data = zope.component.hooks.getSite().data
+    return [data[name]] if name in data else []
+
+
+@shared_task(memoize=dependencies)
+def memoized_task(name):
+    runs.append(name)
+    site = zope.component.hooks.getSite()
+    return site.data[name]['title']
+
+
+def test_memoize__1(interaction, eager_celery_app, zodb):
+    """It returns the cached result without running the task as long as the
+    objects it depends on did not change."""
+    with zodb.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name
+        ].data = persistent.mapping.PersistentMapping(
+            one=persistent.mapping.PersistentMapping(title='One'),
+            two=persistent.mapping.PersistentMapping(title='Two'))
+    zope.security.management.endInteraction()
+    eager_celery_app.conf['MEMOIZE_CACHE_BACKEND'] = LRUCache(
+        eager_celery_app)
+    del runs[:]
+
+    assert 'One' == memoized_task('one', _run_asynchronously_=True)
+    assert 'One' == memoized_task('one', _run_asynchronously_=True)
+    assert 'Two' == memoized_task('two', _run_asynchronously_=True)
+    assert ['one', 'two'] == runs
+
+    with zodb.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name
+        ].data['one']['title'] = 'Eins'
+    transaction.begin()
+    assert 'Eins' == memoized_task('one', _run_asynchronously_=True)
+    assert 'Eins' == memoized_task('one', _run_asynchronously_=True)
+    assert ['one', 'two', 'one'] == runs
+    # Without the objects it depends on, the task is not memoized:
+    with pytest.raises(KeyError):
+        memoized_task('missing', _run_asynchronously_=True)
+
+
+def test_memoize__LRUCache__1(eager_celery_app):
+    """It keeps the `MEMOIZE_MAXSIZE` most recently used entries."""
+    eager_celery_app.conf['MEMOIZE_MAXSIZE'] = 2
+    cache = LRUCache(eager_celery_app)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert 1 == cache.get('a')
+    cache.set('c', 3)
+    assert (1, None, 3) == (cache.get('a'), cache.get('b'), cache.get('c'))
+
+
+def test_memoize__ResultBackendCache__1(eager_celery_app):
+    """It stores the entries as JSON in the result backend."""
+    backend = mock.Mock(spec=celery.backends.base.BaseKeyValueStoreBackend)
+    backend.expires = 60
+    backend.get.return_value = None
+    with mock.patch.object(type(eager_celery_app), 'backend', backend):
+        cache = ResultBackendCache(eager_celery_app)
+    assert cache.get('key') is None
+    cache.set('key', [[['01', '02']], 'result'])
+    backend.set.assert_called_with('key', '[[["01", "02"]], "result"]')
+    backend.expire.assert_called_with('key', 60)
+    backend.get.return_value = backend.set.call_args.args[1]
+    assert [[['01', '02']], 'result'] == cache.get('key')
+
+
+def test_memoize__ResultBackendCache__2(eager_celery_app):
+    """It needs a key/value result backend."""
+    with mock.patch.object(type(eager_celery_app), 'backend', object()):
+        with pytest.raises(ValueError):
+            ResultBackendCache(eager_celery_app)
+
+
+@shared_task(memoize=dependencies, read_only=True)
+def read_only_memoized_task(name):
+    runs.append(name)
+    site = zope.component.hooks.getSite()
+    return site.data[name]['title']
+
+
+def test_memoize__2(interaction, eager_celery_app, zodb):
+    """It memoizes the results of read-only tasks, which do not commit."""
+    with zodb.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name
+        ].data = persistent.mapping.PersistentMapping(
+            one=persistent.mapping.PersistentMapping(title='One'))
+    zope.security.management.endInteraction()
+    eager_celery_app.conf['MEMOIZE_CACHE_BACKEND'] = LRUCache(
+        eager_celery_app)
+    del runs[:]
+
+    assert 'One' == read_only_memoized_task('one', _run_asynchronously_=True)
+    assert 'One' == read_only_memoized_task('one', _run_asynchronously_=True)
+    assert ['one'] == runs
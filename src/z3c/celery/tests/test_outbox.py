@@ -0,0 +1,207 @@
+from ..outbox import LEASE_KEY, OUTBOX_KEY, RelayThread, get_outbox, relay
+from ..outbox import Lease, Outbox, main
+from ..session import celery_session
+from unittest import mock
+import ZODB.POSException
+import celery
+import pytest
+import threading
+import transaction
+import z3c.celery
+import z3c.celery.outbox
+import zope.app.publication.zopepublication
+import zope.component.hooks
+
+
+@z3c.celery.task
+def outbox_task(param=None):
+    """Dummy task to be used together with `eager_celery_app`."""
+
+
+@pytest.fixture(scope='function')
+def outbox_app(eager_celery_app, zodb):
+    """Celery app in outbox mode with the ZODB root folder as site."""
+    eager_celery_app.conf['task_always_eager'] = False
+    eager_celery_app.conf['OUTBOX'] = True
+    z3c.celery.outbox.install(zodb)
+    connection = zodb.open()
+    zope.component.hooks.setSite(connection.root()[
+        zope.app.publication.zopepublication.ZopePublication.root_name])
+    yield eager_celery_app
+    zope.component.hooks.setSite(None)
+    transaction.abort()
+    connection.close()
+
+
+def test_outbox__1(interaction, outbox_app, zodb):
+    """It stores the messages in the ZODB on commit and publishes them when
+    relayed."""
+    with mock.patch.object(celery.Task, 'apply_async', autospec=True) as \
+            apply_async:
+        outbox_task.delay('one')
+        outbox_task.apply_async(('two',), countdown=60)
+        transaction.commit()
+        assert not apply_async.called
+        assert 0 == len(celery_session)
+        with zodb.transaction() as connection:
+            assert 2 == len(get_outbox(connection))
+
+        with mock.patch.object(outbox_app, 'producer_or_acquire') as acquire:
+            assert 2 == relay(outbox_app, zodb, batch_size=1)
+    assert 2 == acquire.call_count
+    producer = acquire.return_value.__enter__.return_value
+    first, second = apply_async.call_args_list
+    assert producer is first.kwargs['producer']
+    assert b'[["one"]' == first.args[1].payload[:8]
+    assert 'countdown' not in second.kwargs
+    assert second.kwargs['eta'] > outbox_app.now()
+    with zodb.transaction() as connection:
+        assert 0 == len(connection.root()[OUTBOX_KEY])
+
+
+def test_outbox__2(interaction, outbox_app):
+    """It sends the messages directly if there is no ZODB connection."""
+    zope.component.hooks.setSite(None)
+    with mock.patch.object(celery.Task, 'apply_async', autospec=True) as \
+            apply_async:
+        outbox_task.delay('one')
+        transaction.commit()
+    assert apply_async.called
+
+
+def test_outbox__3(interaction, outbox_app, zodb):
+    """It stores the tag of the task method, not its name."""
+    outbox_task.delay('one')
+    transaction.commit()
+    with zodb.transaction() as connection:
+        (name, tag, args, kw), = connection.root()[OUTBOX_KEY].values()
+    assert 'apply' == tag
+
+
+def test_outbox__4(interaction, outbox_app, zodb):
+    """It sends the messages directly if the outbox is not installed."""
+    with zodb.transaction() as connection:
+        del connection.root()[OUTBOX_KEY]
+    transaction.begin()
+    with mock.patch.object(celery.Task, 'apply_async', autospec=True) as \
+            apply_async:
+        outbox_task.delay('one')
+        transaction.commit()
+    assert apply_async.called
+
+
+def test_outbox__Outbox__add__1():
+    """It refuses methods without a tag."""
+    with pytest.raises(ValueError):
+        Outbox({}).add(outbox_task.apply_async, (), {})
+
+
+def test_outbox__relay__1(interaction, outbox_app, zodb):
+    """It does not publish while another relay holds the lease."""
+    outbox_task.delay('one')
+    transaction.commit()
+    with zodb.transaction() as connection:
+        connection.root()[LEASE_KEY].claim('other', 60)
+    with mock.patch.object(celery.Task, 'apply_async') as apply_async:
+        assert 0 == relay(outbox_app, zodb)
+        assert not apply_async.called
+        with zodb.transaction() as connection:
+            connection.root()[LEASE_KEY].release('other')
+        assert 1 == relay(outbox_app, zodb)
+    with zodb.transaction() as connection:
+        assert connection.root()[LEASE_KEY].owner is None
+
+
+def test_outbox__relay__2(interaction, outbox_app, zodb):
+    """It does not publish if another relay claimed the lease at the same
+    time."""
+    outbox_task.delay('one')
+    transaction.commit()
+    with mock.patch.object(celery.Task, 'apply_async') as apply_async, \
+            mock.patch.object(Lease, 'claim',
+                              side_effect=ZODB.POSException.ConflictError()):
+        assert 0 == relay(outbox_app, zodb)
+    assert not apply_async.called
+
+
+def test_outbox__relay__3(outbox_app, zodb):
+    """It does not claim the lease if the outbox is empty."""
+    with mock.patch.object(Lease, 'claim') as claim:
+        assert 0 == relay(outbox_app, zodb)
+    assert not claim.called
+
+
+def test_outbox__relay__4(interaction, outbox_app, zodb):
+    """It stops publishing if it cannot renew the lease."""
+    outbox_task.delay('one')
+    transaction.commit()
+    with mock.patch.object(celery.Task, 'apply_async') as apply_async, \
+            mock.patch.object(Lease, 'claim', side_effect=[True, False]):
+        assert 0 == relay(outbox_app, zodb)
+    assert not apply_async.called
+
+
+def test_outbox__install__1(zodb):
+    """It keeps an existing outbox and lease."""
+    z3c.celery.outbox.install(zodb)
+    with zodb.transaction() as connection:
+        outbox = connection.root()[OUTBOX_KEY]
+        outbox['key'] = 'message'
+        connection.root()[LEASE_KEY].claim('owner', 60)
+    z3c.celery.outbox.install(zodb)
+    with zodb.transaction() as connection:
+        assert 'message' == connection.root()[OUTBOX_KEY]['key']
+        lease = connection.root()[LEASE_KEY]
+        # Only the owner can release the lease:
+        lease.release('other')
+        assert 'owner' == lease.owner
+
+
+def test_outbox__RelayThread__1(outbox_app, zodb):
+    """It relays the outbox periodically."""
+    called = threading.Event()
+    with mock.patch('z3c.celery.outbox.relay',
+                    side_effect=lambda *args: called.set()) as relay:
+        thread = RelayThread(outbox_app, zodb, interval=0.01)
+        thread.start()
+        assert called.wait(timeout=10)
+        thread.stop()
+    relay.assert_called_with(outbox_app, zodb, 1000)
+
+
+def test_outbox__RelayThread__2(outbox_app, zodb):
+    """It keeps relaying if relaying failed."""
+    called = threading.Event()
+    results = [RuntimeError(), None]
+
+    def relay(*args):
+        result = results.pop(0)
+        if result is not None:
+            raise result
+        called.set()
+
+    with mock.patch('z3c.celery.outbox.relay', side_effect=relay), \
+            mock.patch('z3c.celery.outbox.log') as log:
+        thread = RelayThread(outbox_app, zodb, interval=0.01)
+        thread.start()
+        assert called.wait(timeout=10)
+        thread.stop()
+    assert log.error.called
+
+
+def test_outbox__main__1(eager_celery_app):
+    """It installs the outbox of the configured ZODB and relays it until it
+    is interrupted."""
+    db = mock.Mock()
+    with mock.patch('zope.app.wsgi.config', return_value=db) as config, \
+            mock.patch.object(eager_celery_app.loader,
+                              'import_default_modules'), \
+            mock.patch('z3c.celery.outbox.install') as install, \
+            mock.patch('z3c.celery.outbox.relay',
+                       side_effect=[1, KeyboardInterrupt]) as relay, \
+            mock.patch('time.sleep'):
+        main(['--batch-size=10'])
+    config.assert_called_with(eager_celery_app.conf['ZOPE_CONF'])
+    install.assert_called_with(db)
+    relay.assert_called_with(eager_celery_app, db, 10)
+    assert db.close.called
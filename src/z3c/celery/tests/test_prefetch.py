@@ -0,0 +1,53 @@
+from ..prefetch import resolve, task_prefetch
+from celery import shared_task
+from unittest import mock
+import persistent.mapping
+import zope.app.publication.zopepublication
+import zope.component.hooks
+import zope.security.management
+
+
+def children(task, *names):
+    site = zope.component.hooks.getSite()
+    return [site.data._p_oid] + [
+        site.data[name] for name in names if name in site.data]
+
+
+@shared_task(prefetch=children)
+def prefetch_task(*names):
+    site = zope.component.hooks.getSite()
+    return [site.data[name]['title'] for name in names[:1]]
+
+
+def test_prefetch__1(interaction, eager_celery_app, zodb):
+    """It prefetches the declared objects before the task runs and reports
+    the saved loads."""
+    with zodb.transaction() as connection:
+        connection.root()[
+            zope.app.publication.zopepublication.ZopePublication.root_name
+        ].data = persistent.mapping.PersistentMapping(
+            one=persistent.mapping.PersistentMapping(title='One'),
+            two=persistent.mapping.PersistentMapping(title='Two'))
+    zodb.cacheMinimize()
+    zope.security.management.endInteraction()
+    receiver = mock.Mock()
+    task_prefetch.connect(receiver, weak=False)
+    try:
+        with mock.patch('ZODB.Connection.Connection.prefetch') as prefetch:
+            assert ['One'] == prefetch_task(
+                'one', 'two', 'missing', _run_asynchronously_=True)
+    finally:
+        task_prefetch.disconnect(receiver)
+    # `data` was loaded to look up its items, so it is not prefetched.
+    assert 2 == len(prefetch.call_args.args[0])
+    assert 2 == receiver.call_args.kwargs['prefetched']
+    assert 1 == receiver.call_args.kwargs['saved']
+
+
+def test_prefetch__resolve__1():
+    """It skips items which are not persistent or cannot be found."""
+    site = persistent.mapping.PersistentMapping(
+        one=persistent.mapping.PersistentMapping())
+    site._p_jar = mock.Mock()
+    site._p_oid = site['one']._p_oid = b'1'
+    assert [site['one']] == resolve(site, ['/one/', 'two', 'one/x', object()])
@@ -0,0 +1,56 @@
+from ..serialization import Arguments, dumps, encode, reprs
+from ..serialization import CONTENT_TYPE, SERIALIZER
+import json
+import kombu.serialization
+import pytest
+
+
+def test_serialization__dumps__1():
+    """It serializes to JSON bytes."""
+    assert b'[["a"], {"b": 1}]' == dumps([['a'], {'b': 1}])
+
+
+def test_serialization__dumps__2():
+    """It raises a TypeError if the object is not JSON serializable."""
+    with pytest.raises(TypeError):
+        dumps([object()])
+
+
+def test_serialization__dumps__3():
+    """It uses the encoder given by dotted name."""
+    assert b'[1,2]' == dumps(
+        [1, 2], 'z3c.celery.tests.test_serialization.compact_dumps')
+
+
+def compact_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def test_serialization__encode__1():
+    """It reuses the payload of `Arguments` as args and kwargs."""
+    body = (Arguments(b'[["a"],{"b":1}]'), {}, {'chord': None})
+    assert [['a'], {'b': 1}, {'chord': None}] == json.loads(encode(body))
+
+
+def test_serialization__encode__2():
+    """It serializes other bodies as plain JSON."""
+    body = (['a'], {'b': 1}, {'chord': None})
+    assert [['a'], {'b': 1}, {'chord': None}] == json.loads(encode(body))
+
+
+def test_serialization__reprs__1():
+    """It returns args and kwargs of the payload as truncated JSON."""
+    assert ('["a", [1, 2]]', '{"b": 1}') == reprs(
+        b'[["a", [1, 2]], {"b": 1}]', 100, 100)
+    assert ('[]', '{"_ch') == reprs(b'[[],{"_chunk_":[]}]', 100, 5)
+
+
+def test_serialization__register__1():
+    """It registers the serializer with a content type of its own."""
+    registry = kombu.serialization.registry
+    assert 'json' == registry.type_to_name['application/json']
+    content_type, encoding, data = kombu.serialization.dumps(
+        (Arguments(b'[["a"], {}]'), {}, {}), serializer=SERIALIZER)
+    assert CONTENT_TYPE == content_type
+    assert [['a'], {}, {}] == kombu.serialization.loads(
+        data, content_type, encoding, accept=[CONTENT_TYPE])
@@ -1,4 +1,14 @@
 from ..session import celery_session, CeleryDataManager
+from unittest import mock
+import celery
+import json
+import transaction
+import z3c.celery
+
+
+@z3c.celery.task
+def session_task(param=None):
+    """Dummy task to be used together with `eager_celery_app`."""
 
 
 def test_session__CeleryDataManager____repr____1():
@@ -6,3 +16,52 @@ def test_session__CeleryDataManager____repr____1():
     dm = CeleryDataManager(celery_session)
     assert repr(dm).startswith(
         '<z3c.celery.session.CeleryDataManager for <transaction')
+
+
+def test_session__CelerySession___flush__1(interaction, eager_celery_app):
+    """It publishes all tasks of the session using a single producer if
+    `BULK_PUBLISH` is set."""
+    eager_celery_app.conf['task_always_eager'] = False
+    eager_celery_app.conf['BULK_PUBLISH'] = True
+    with mock.patch.object(celery.Task, 'apply_async', autospec=True) as \
+            apply_async, \
+            mock.patch.object(eager_celery_app, 'producer_or_acquire') as \
+            acquire:
+        session_task.delay('one')
+        session_task.delay('two')
+        transaction.commit()
+    assert 1 == acquire.call_count
+    producer = acquire.return_value.__enter__.return_value
+    assert 2 == apply_async.call_count
+    for call in apply_async.call_args_list:
+        assert producer is call.kwargs['producer']
+    assert [['one'], ['two']] == [
+        json.loads(call.args[1].payload)[0]
+        for call in apply_async.call_args_list]
+    assert 0 == len(celery_session)
+
+
+def test_session__CelerySession___flush__2(interaction, eager_celery_app):
+    """It acquires a producer for each task without `BULK_PUBLISH`."""
+    eager_celery_app.conf['task_always_eager'] = False
+    with mock.patch.object(celery.Task, 'apply_async', autospec=True) as \
+            apply_async, \
+            mock.patch.object(eager_celery_app, 'producer_or_acquire') as \
+            acquire:
+        session_task.delay('one')
+        transaction.commit()
+    assert not acquire.called
+    assert 'producer' not in apply_async.call_args.kwargs
+
+
+def test_session__CelerySession__add_chunked_call__1():
+    """It collects items into chunks of the given size which are passed to
+    the method on flush."""
+    method = mock.Mock()
+    for i in range(5):
+        celery_session.add_chunked_call(method, i, 2)
+    assert 5 == len(celery_session)
+    transaction.commit()
+    assert [mock.call([0, 1]), mock.call([2, 3]), mock.call([4])] == (
+        method.call_args_list)
+    assert 0 == len(celery_session)
@@ -0,0 +1,50 @@
+from ..testing import IN_MEMORY_ZOPE_CONF_TEMPLATE, open_zodb_copy
+from zope.principalregistry.principalregistry import principalRegistry
+import ZODB
+import ZODB.FileStorage
+import ZODB.MappingStorage
+import os
+import persistent.mapping
+import plone.testing.zca
+import transaction
+import zope.app.appsetup.appsetup
+import zope.app.wsgi
+
+
+def test_testing__open_zodb_copy__1(tmp_path):
+    """It opens the ZODB read-only below a DemoStorage with `copy=False`."""
+    path = str(tmp_path / 'Data.fs')
+    db = ZODB.DB(ZODB.FileStorage.FileStorage(path))
+    with db.transaction() as connection:
+        connection.root()['Application'] = (
+            persistent.mapping.PersistentMapping(foo='bar'))
+    # Still opened by another process, which holds the lock.
+    try:
+        with open_zodb_copy(path, copy=False) as app:
+            assert 'bar' == app['foo']
+            app['changed'] = True
+            transaction.commit()
+            assert not os.path.exists(path + '.copy')
+    finally:
+        transaction.abort()
+    with db.transaction() as connection:
+        assert 'changed' not in connection.root()['Application']
+    db.close()
+
+
+def test_testing__IN_MEMORY_ZOPE_CONF_TEMPLATE__1(tmp_path):
+    """It configures Zope with an in-memory ZODB."""
+    conf = tmp_path / 'zope.conf'
+    conf.write_text(IN_MEMORY_ZOPE_CONF_TEMPLATE.format(
+        zodb_path='ignored', product_config='',
+        ftesting_path=os.path.dirname(os.path.dirname(__file__)) +
+        '/ftesting.zcml'))
+    plone.testing.zca.pushGlobalRegistry()
+    try:
+        db = zope.app.wsgi.config(str(conf))
+        assert isinstance(db.storage, ZODB.MappingStorage.MappingStorage)
+        db.close()
+    finally:
+        plone.testing.zca.popGlobalRegistry()
+        principalRegistry._clear()
+        zope.app.appsetup.appsetup.reset()
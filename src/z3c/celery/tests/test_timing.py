@@ -0,0 +1,49 @@
+from ..timing import Histograms, task_phase
+from .shared_tasks import get_principal_title_task
+from unittest import mock
+import pytest
+import zope.security.management
+
+
+@pytest.fixture(scope='function')
+def histograms():
+    histograms = Histograms(buckets=(1, 10))
+    histograms.connect()
+    yield histograms
+    histograms.disconnect()
+
+
+def test_timing__Histograms__1(histograms):
+    """It collects durations per task name and phase."""
+    for duration in (0.5, 2, 20):
+        task_phase.send(
+            sender=None, phase='run', duration=duration, task_id='1',
+            task_name='task')
+    task_phase.send(
+        sender=None, phase='commit', duration=0.1, task_id='1',
+        task_name='task')
+    assert {'task': {
+        'commit': {'count': 1, 'sum': 0.1, 'buckets': [1, 0, 0]},
+        'run': {'count': 3, 'sum': 22.5, 'buckets': [1, 1, 1]},
+    }} == histograms.report()
+    histograms.reset()
+    assert {} == histograms.report()
+
+
+def test_timing__phase__1(histograms, interaction, eager_celery_app, zcml,
+                          zodb):
+    """It reports the duration of each phase of a task run in the worker."""
+    zope.security.management.endInteraction()
+    receiver = mock.Mock()
+    task_phase.connect(receiver, weak=False)
+    try:
+        get_principal_title_task(
+            _run_asynchronously_=True, _principal_id_='example.user')
+    finally:
+        task_phase.disconnect(receiver)
+    assert ['zope', 'login', 'run', 'commit'] == [
+        x.kwargs['phase'] for x in receiver.call_args_list]
+    name = 'z3c.celery.tests.shared_tasks.get_principal_title_task'
+    assert {'commit', 'login', 'run', 'zope'} == set(
+        histograms.report()[name])
+    assert name == receiver.call_args.kwargs['sender'].name
@@ -0,0 +1,87 @@
+import bisect
+import celery.utils.dispatch
+import contextlib
+import threading
+import time
+
+
+# Sent after each phase of running a task in the worker with the keyword
+# arguments `phase`, `duration` (seconds), `task_id` and `task_name`.
+# The sender is the task. Phases are:
+#
+# * zope: open the ZODB connection and set the site
+# * login: look up the principal and start the interaction
+# * run: run the task itself
+# * commit: commit the transaction (including tpc_vote of all data managers)
+# * after_abort: handle HandleAfterAbort exceptions
+# * retry: schedule a retry after a ConflictError
+# * prefetch: prefetch the objects declared by the task, see `prefetch`
+# * memoize: look up the cached result of the task, see `memoize`
+task_phase = celery.utils.dispatch.Signal(name='task_phase')
+
+
+@contextlib.contextmanager
+def phase(task, name):
+    """Measure the duration of the phase `name` of `task`."""
+    if not task_phase.receivers:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        task_phase.send(
+            sender=task, phase=name, duration=time.perf_counter() - start,
+            task_id=task.request.id, task_name=task.name)
+
+
+class Histograms:
+    """Collect the durations of task phases into histograms per task name and
+    phase.
+
+    `buckets` are the upper bounds (in seconds) of the histogram buckets, the
+    last bucket takes all durations above the last bound.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, sender, phase, duration, task_name, **kw):
+        index = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            data = self._data.get((task_name, phase))
+            if data is None:
+                data = self._data[(task_name, phase)] = dict(
+                    count=0, sum=0.0, buckets=[0] * (len(self.buckets) + 1))
+            data['count'] += 1
+            data['sum'] += duration
+            data['buckets'][index] += 1
+
+    def connect(self):
+        task_phase.connect(self, weak=False, dispatch_uid=id(self))
+
+    def disconnect(self):
+        task_phase.disconnect(self, dispatch_uid=id(self))
+
+    def report(self):
+        """Return the histograms as `{task_name: {phase: histogram}}`."""
+        result = {}
+        with self._lock:
+            for (task_name, phase), data in sorted(self._data.items()):
+                result.setdefault(task_name, {})[phase] = dict(
+                    data, buckets=list(data['buckets']))
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Default collector, connected by the ZopeLoader if `TASK_PHASE_HISTOGRAMS`
+# is set in the celery config.
+histograms = Histograms()